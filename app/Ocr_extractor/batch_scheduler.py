@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from app.Ocr_extractor.ocr_extractor import OCRExtractor, ScanImage
+
+logger = logging.getLogger(__name__)
+
+ImageInput = Union[Image.Image, np.ndarray, ScanImage]
+
+
+class QueueFullError(RuntimeError):
+    """Raised by BatchScheduler.submit when the admission queue is full"""
+
+
+class BatchScheduler:
+    """
+    Dynamic micro-batching in front of OCRExtractor.batch_extract
+
+    Requests are queued by the event loop and picked up by num_workers
+    worker threads, which group them into micro-batches bounded by
+    max_batch_size and max_wait_ms, run the models once per batch and
+    resolve each request's future. Inference never runs on the event loop.
+
+    The queue holds at most max_queue_size waiting requests; beyond that
+    submit raises QueueFullError so callers can shed load instead of
+    letting latency grow without bound. Requests cancelled while queued
+    (e.g. the client disconnected) are dropped before inference.
+
+    The extractor is obtained through get_extractor on the worker thread,
+    so lazily loaded models are also loaded off the event loop.
+    """
+
+    def __init__(
+        self,
+        get_extractor: Callable[[], OCRExtractor],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue_size: int = 0,
+        num_workers: int = 1
+    ):
+        """
+        Args:
+            get_extractor: Returns the extractor used for each micro-batch
+            max_batch_size: Maximum number of images per batch
+            max_wait_ms: Maximum time to wait for a batch to fill up after
+                its first request arrived
+            max_queue_size: Maximum number of waiting requests, 0 for
+                unbounded
+            num_workers: Number of worker threads running batches
+        """
+        self.get_extractor = get_extractor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.max_queue_size = max_queue_size
+        self.num_workers = max(1, num_workers)
+
+        self._queue: "queue.Queue[Tuple[ImageInput, Optional[float], asyncio.Future, asyncio.AbstractEventLoop]]" = queue.Queue()
+        self._reserved = 0
+        self._reserved_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """Start the worker threads"""
+        if any(thread.is_alive() for thread in self._threads):
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"batch-scheduler-{i}", daemon=True)
+            for i in range(self.num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(
+            f"Batch scheduler started (workers={self.num_workers}, "
+            f"max_batch_size={self.max_batch_size}, "
+            f"max_wait_ms={self.max_wait * 1000:.1f}, "
+            f"max_queue_size={self.max_queue_size})"
+        )
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the worker threads after their current batch"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def queue_size(self) -> int:
+        """Number of requests waiting for a worker"""
+        return self._queue.qsize()
+
+    def reserve(self) -> "Reservation":
+        """
+        Hold a queue slot for a request that still has work to do before
+        submit, such as decoding the image
+
+        Reserved slots count towards max_queue_size, so requests are turned
+        away before they decode while the queue is full. Pass the
+        reservation to submit, which hands the slot over to the queued
+        request, and release it if the request is abandoned earlier.
+
+        Raises:
+            QueueFullError: If max_queue_size requests are already queued
+                or reserved
+        """
+        with self._reserved_lock:
+            self._check_full()
+            self._reserved += 1
+        return Reservation(self)
+
+    def _check_full(self) -> None:
+        # called with _reserved_lock held
+        if self.max_queue_size and self._queue.qsize() + self._reserved >= self.max_queue_size:
+            raise QueueFullError(f"{self.max_queue_size} requests already queued")
+
+    def _release(self, reservation: "Reservation") -> None:
+        # called with _reserved_lock held
+        if reservation.held:
+            reservation.held = False
+            self._reserved -= 1
+
+    async def submit(
+        self,
+        image: ImageInput,
+        min_confidence: Optional[float] = None,
+        reservation: Optional["Reservation"] = None
+    ) -> Dict:
+        """
+        Queue an image and wait for its extraction result
+
+        Args:
+            image: Input PIL Image, RGB array or ScanImage
+            min_confidence: See OCRExtractor.extract_info
+            reservation: Slot held with reserve(); the request takes it
+                over instead of competing for a new one
+
+        Returns:
+            Dictionary of extracted information
+
+        Raises:
+            QueueFullError: If max_queue_size requests are already waiting
+                and no reservation was given
+        """
+        if not self._threads:
+            self.start()
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # the reserved slot becomes the queued request's in one step
+        with self._reserved_lock:
+            if reservation is not None and reservation.held:
+                self._release(reservation)
+            else:
+                self._check_full()
+            self._queue.put_nowait((image, min_confidence, future, loop))
+        return await future
+
+    def _collect_batch(self) -> List[Tuple[ImageInput, Optional[float], asyncio.Future, asyncio.AbstractEventLoop]]:
+        """Block for the first request, then gather more until full or timed out"""
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._collect_batch()
+
+            # Drop requests whose client already went away
+            batch = [item for item in batch if not item[2].done()]
+            if not batch:
+                continue
+
+            images = [image for image, _, _, _ in batch]
+            thresholds = [threshold for _, threshold, _, _ in batch]
+            try:
+                results = self.get_extractor().batch_extract(images, min_confidence=thresholds)
+            except Exception as e:
+                logger.error(f"Batch of {len(images)} failed: {e}")
+                for _, _, future, loop in batch:
+                    loop.call_soon_threadsafe(_set_exception, future, e)
+                continue
+
+            for (_, _, future, loop), result in zip(batch, results):
+                loop.call_soon_threadsafe(_set_result, future, result)
+
+
+class Reservation:
+    """A queue slot held with BatchScheduler.reserve"""
+
+    def __init__(self, scheduler: BatchScheduler):
+        self.scheduler = scheduler
+        self.held = True
+
+    def release(self) -> None:
+        """Give the slot back; does nothing once released or queued"""
+        with self.scheduler._reserved_lock:
+            self.scheduler._release(self)
+
+
+def _set_result(future: asyncio.Future, result: Dict) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exc: Exception) -> None:
+    if not future.done():
+        future.set_exception(exc)
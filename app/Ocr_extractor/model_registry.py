@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional
+
+from app.Ocr_extractor.ocr_extractor import OCRExtractor
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    Process-wide owner of OCRExtractor instances
+
+    Extractors are keyed by their constructor arguments, so every route
+    asking for the same configuration shares one set of YOLO and VietOCR
+    weights. Instances are created on the first get() - either eagerly at
+    startup or lazily on the first request.
+    """
+
+    def __init__(self):
+        self._extractors: Dict[Hashable, OCRExtractor] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(config: Dict[str, Any]) -> Hashable:
+        """Turn constructor arguments into a hashable key"""
+        def freeze(value):
+            if isinstance(value, dict):
+                return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+            if isinstance(value, (set, frozenset)):
+                return tuple(sorted(value))
+            if isinstance(value, list):
+                return tuple(freeze(v) for v in value)
+            return value
+
+        return freeze(config)
+
+    def get(self, config: Dict[str, Any]) -> OCRExtractor:
+        """
+        Return the extractor for config, loading it on first use
+
+        Args:
+            config: Keyword arguments for OCRExtractor
+
+        Returns:
+            Shared OCRExtractor instance
+        """
+        key = self._make_key(config)
+        extractor = self._extractors.get(key)
+        if extractor is not None:
+            return extractor
+
+        with self._lock:
+            extractor = self._extractors.get(key)
+            if extractor is None:
+                start = time.perf_counter()
+                extractor = OCRExtractor(**config)
+                self._extractors[key] = extractor
+                logger.info(f"Loaded OCRExtractor in {time.perf_counter() - start:.2f}s")
+        return extractor
+
+    def get_loaded(self, config: Dict[str, Any]) -> Optional[OCRExtractor]:
+        """Return the extractor for config if it is already loaded"""
+        return self._extractors.get(self._make_key(config))
+
+    def clear(self) -> None:
+        """Release all extractors"""
+        with self._lock:
+            self._extractors.clear()
+
+
+# Shared by all routes of the process
+model_registry = ModelRegistry()
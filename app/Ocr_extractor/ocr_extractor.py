@@ -2,8 +2,9 @@
 from ultralytics import YOLO
 from app.vietocr.vietocr.tool.predictor import Predictor
 from app.vietocr.vietocr.tool.config import Cfg
+from app.vietocr.vietocr.tool.export import export_onnx, onnx_session_options, read_onnx_meta
 import cv2
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple, Union
 import torch
 from PIL import Image
 import numpy as np
@@ -12,18 +13,135 @@ from pathlib import Path
 from functools import lru_cache
 from app.core.config.constants import YOLO_MODEL, YOLO_LOCAL
 import re
+import hashlib
+import io
+import threading
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class ScanImage:
+    """
+    An uploaded scan, decoded once for both detection and recognition
+    
+    VietOCR only needs crops a few times its input height, so large JPEGs
+    are decoded with DCT scaling at 1/2, 1/4 or 1/8 resolution when the
+    expected smallest field (text_height_ratio of the image height, a
+    fixed setting) stays at least min_text_height tall and
+    the long side at least detection_size. Decoding at 1/k costs roughly
+    1/k^2 of a full decode. Otherwise the image is decoded at full
+    resolution. The detection image is a cv2.resize of that decode to
+    detection_size, which YOLO letterboxes to anyway.
+    
+    Only if the detected fields turn out smaller than expected is the
+    image decoded a second time, at a resolution that keeps them readable.
+    """
+    
+    REDUCTIONS = (8, 4, 2)
+    
+    def __init__(
+        self,
+        contents: bytes,
+        detection_size: int,
+        min_text_height: int = 64,
+        text_height_ratio: Optional[float] = None
+    ):
+        """
+        Args:
+            contents: Encoded image bytes
+            detection_size: Minimum long side of the detection image
+            min_text_height: Minimum height of a field crop, in pixels
+            text_height_ratio: Expected height of the smallest field
+                relative to the image height, None if unknown
+        """
+        self.contents = contents
+        self.min_text_height = min_text_height
+        self.reduction = 1
+        self.is_jpeg = False
+        
+        try:
+            with Image.open(io.BytesIO(contents)) as header:
+                self.size = header.size
+                self.is_jpeg = header.format == 'JPEG'
+        except Exception:
+            # Let decode_image try OpenCV and report the error
+            pass
+        
+        if self.is_jpeg and text_height_ratio is not None:
+            text_height = text_height_ratio * self.size[1]
+            for factor in self.REDUCTIONS:
+                if max(self.size) // factor >= detection_size and text_height / factor >= min_text_height:
+                    self.reduction = factor
+                    break
+        
+        self.image = OCRExtractor.decode_image(contents, self.reduction)
+        if self.reduction == 1:
+            self.size = (self.image.shape[1], self.image.shape[0])
+        
+        h, w = self.image.shape[:2]
+        scale = detection_size / max(h, w)
+        if scale < 1:
+            size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+            # same interpolation as YOLO's own letterbox resize
+            self.detection = cv2.resize(self.image, size, interpolation=cv2.INTER_LINEAR)
+        else:
+            self.detection = self.image
+    
+    def to_full_resolution(self, bbox: List[int]) -> List[int]:
+        """Map a bbox from the detection image to the full-resolution image"""
+        w, h = self.size
+        scale_x = w / self.detection.shape[1]
+        scale_y = h / self.detection.shape[0]
+        x1, y1, x2, y2 = bbox
+        return [
+            min(w, max(0, int(round(x1 * scale_x)))),
+            min(h, max(0, int(round(y1 * scale_y)))),
+            min(w, max(0, int(round(x2 * scale_x)))),
+            min(h, max(0, int(round(y2 * scale_y)))),
+        ]
+    
+    def recognition_image(self, bboxes: List[List[int]]) -> Tuple[np.ndarray, int]:
+        """
+        Image to crop the given full-resolution boxes from
+        
+        Returns:
+            The decoded image and its reduction, or a new decode at a lower
+            reduction if the smallest box would be shorter than
+            min_text_height
+        """
+        if self.reduction == 1 or not bboxes:
+            return self.image, self.reduction
+        
+        min_height = min(y2 - y1 for _, y1, _, y2 in bboxes)
+        if min_height / self.reduction >= self.min_text_height:
+            return self.image, self.reduction
+        
+        reduction = next(
+            (factor for factor in self.REDUCTIONS
+             if factor < self.reduction and min_height / factor >= self.min_text_height),
+            1
+        )
+        return OCRExtractor.decode_image(self.contents, reduction), reduction
+
+
 class OCRExtractor:
     """OCR Extractor for Vietnamese Birth Certificate with optimizations"""
     
     # Constants
     DEFAULT_PADDING = 2
     MIN_CONFIDENCE_THRESHOLD = 0.3
+    MIN_ROW_OVERLAP = 0.5
+    DETECTION_SIZE = 640
+    RESULT_VERSION = 3
+    BACKENDS = ('torch', 'onnx')
+    VIETOCR_ONNX_DIR = 'vietocr_onnx'
+    
+    # Field roles: label boxes are inputs to routing rules, not outputs
+    MOTHER_FIELD = 'Họ và tên Mẹ'
+    FATHER_FIELD = 'Họ và tên Cha'
+    LABEL_FIELDS = {'k_name', 'k_m_name', 'k_c_name'}
     
     def __init__(
         self, 
@@ -32,7 +150,17 @@ class OCRExtractor:
         extract_fields: Optional[Set[str]] = None,
         class_mapping: Optional[Dict[int, str]] = None,
         batch_size: int = 1,
-        use_half_precision: bool = False
+        use_half_precision: bool = False,
+        use_int8: bool = False,
+        calibration_dir: Optional[str] = None,
+        calibration_stats: Optional[str] = None,
+        return_labels: bool = False,
+        beam_threshold: Optional[float] = None,
+        backend: str = 'torch',
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        confidence_calibration: Optional[Tuple[float, float]] = None,
+        text_height_ratio: Optional[float] = None
     ):
         """
         Initialize YOLO model and VietOCR
@@ -43,16 +171,59 @@ class OCRExtractor:
             class_mapping: Custom class mapping (optional)
             batch_size: Batch size for processing multiple images
             use_half_precision: Use FP16 for faster inference (GPU only)
+            use_int8: Run VietOCR in INT8 (torch backend on CPU only), see
+                quantize_ocr
+            calibration_dir: Certificate scans whose field crops calibrate
+                the INT8 convolutions at start up (optional, e.g. a mounted
+                volume)
+            calibration_stats: Activation ranges of the INT8 convolutions
+                calibrated offline (see app.int8_report --save-stats),
+                preferred over calibration_dir (optional)
+            return_labels: Also return label fields (k_name, k_m_name,
+                k_c_name). If False they are only read when the parent
+                swap rule needs them
+            beam_threshold: Re-read crops whose greedy mean character
+                probability is below this with beam search (optional)
+            backend: 'torch', or 'onnx' to run YOLO and VietOCR with ONNX
+                Runtime on CPU. The ONNX models are exported next to the
+                YOLO model on first use, see export_onnx
+            intra_op_threads: ONNX Runtime threads per operator, 0 for
+                torch.get_num_threads()
+            inter_op_threads: ONNX Runtime threads for independent
+                operators, 0 or 1 for sequential execution
+            confidence_calibration: (slope, intercept) mapping field_score
+                to field_confidence, see fit_confidence_calibration. If
+                None, field_confidence is the uncalibrated field_score
+            text_height_ratio: Expected height of the smallest field
+                relative to the scan height, used to decode large JPEGs at
+                reduced resolution (see ScanImage). None decodes at full
+                resolution
         """
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {self.BACKENDS}")
+        
         self._validate_model_path(yolo_model_path)
+        self.yolo_model_path = yolo_model_path
+        self.beam_threshold = beam_threshold
+        self.backend = backend
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.confidence_calibration = confidence_calibration
+        self.text_height_ratio = text_height_ratio
         
         # Device setup
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        logger.info(f"Using device: {self.device}")
+        if backend == 'onnx':
+            self.device = 'cpu'
+        else:
+            self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        logger.info(f"Using device: {self.device} ({backend} backend)")
         
         # Load YOLO model with error handling
         try:
-            self.yolo_model = YOLO(yolo_model_path)
+            self.yolo_model = self._load_yolo(yolo_model_path)
+            # The ultralytics predictor keeps per-call state on the model, so
+            # scheduler workers take turns running detection
+            self._yolo_lock = threading.Lock()
             if use_half_precision and self.device == 'cuda':
                 self.yolo_model.model.half()
                 logger.info("Using FP16 precision")
@@ -76,47 +247,293 @@ class OCRExtractor:
         
         self.extract_fields = extract_fields
         self.batch_size = batch_size
+        self.return_labels = return_labels
+        
+        self.int8 = False
+        self.calibration_dir = None
+        self.calibration_stats = None
+        if use_int8:
+            if self.backend == 'torch' and self.device == 'cpu':
+                self.quantize_ocr(calibration_dir, calibration_stats)
+            else:
+                logger.warning("INT8 OCR needs the torch backend on CPU, keeping fp32")
         
     def _validate_model_path(self, path: str) -> None:
         """Validate model file exists"""
         if not Path(path).exists():
             raise FileNotFoundError(f"Model not found: {path}")
     
+    def fingerprint(self) -> str:
+        """
+        Short hash of everything that changes extraction results: model
+        files, OCR weights and field settings. Used to version cached results.
+        """
+        if getattr(self, '_fingerprint', None) is not None:
+            return self._fingerprint
+        
+        yolo_stat = Path(self.yolo_model_path).stat()
+        parts = [
+            self.yolo_model_path,
+            yolo_stat.st_size,
+            yolo_stat.st_mtime_ns,
+            self.ocr_predictor.config['weights'],
+            sorted(self.extract_fields or []),
+            sorted(self.class_mapping.items()),
+            self.return_labels,
+            self.beam_threshold,
+            self.backend,
+            self.int8,
+            self.calibration_dir,
+            self.calibration_stats,
+            self.confidence_calibration,
+            self.text_height_ratio,
+            self.DETECTION_SIZE,
+            self.RESULT_VERSION,
+        ]
+        self._fingerprint = hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:16]
+        return self._fingerprint
+    
+    @staticmethod
+    def _ocr_config(device: str) -> Dict:
+        """VietOCR config of the extractor"""
+        config = Cfg.load_config_from_name('vgg_transformer')
+        config['cnn']['pretrained'] = False
+        config['device'] = device
+        config['predictor']['beamsearch'] = False
+        return config
+    
     def _initialize_ocr(self) -> Predictor:
         """Initialize VietOCR with error handling"""
         try:
-            config = Cfg.load_config_from_name('vgg_transformer')
-            config['cnn']['pretrained'] = False
-            config['device'] = self.device
-            config['predictor']['beamsearch'] = False
+            config = self._ocr_config(self.device)
+            config['predictor']['beamsearch_threshold'] = self.beam_threshold
+            if self.backend == 'onnx':
+                config['predictor']['exported'] = self._export_ocr_onnx(self.yolo_model_path)
+                config['predictor']['intra_op_threads'] = self.intra_op_threads
+                config['predictor']['inter_op_threads'] = self.inter_op_threads
             return Predictor(config)
         except Exception as e:
             logger.error(f"Failed to initialize OCR: {e}")
             raise
     
-    def preprocess_image(self, image: Image.Image) -> np.ndarray:
+    def _load_yolo(self, path: str) -> YOLO:
+        """Load the YOLO model for the configured backend"""
+        if self.backend == 'torch':
+            return YOLO(path)
+        
+        onnx_path = self._export_yolo_onnx(path)
+        model = YOLO(onnx_path, task='detect')
+        
+        # ultralytics creates its ONNX Runtime session with default options
+        # on the first predict; replace it with one using our thread settings
+        model.predict(np.zeros((self.DETECTION_SIZE, self.DETECTION_SIZE, 3), dtype=np.uint8), verbose=False)
+        backend = getattr(model.predictor.model, 'backend', None)
+        if getattr(backend, 'session', None) is None:
+            logger.warning("Unknown ultralytics ONNX backend, keeping its default session options")
+            return model
+        
+        import onnxruntime as ort
+        options = onnx_session_options(self.intra_op_threads, self.inter_op_threads)
+        backend.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        return model
+    
+    @classmethod
+    def export_onnx(cls, yolo_model_path: str = YOLO_MODEL) -> Tuple[str, str]:
+        """
+        Export YOLO and VietOCR to ONNX unless up-to-date exports exist
+        
+        YOLO is exported by ultralytics to a .onnx file next to the .pt file,
+        with dynamic batch and image size. VietOCR is exported by
+        tool.export.export_onnx to a vietocr_onnx directory next to it.
+        Exports older than the YOLO model or made from other OCR weights are
+        replaced.
+        
+        Args:
+            yolo_model_path: Path to trained YOLO model
+            
+        Returns:
+            Paths of the YOLO ONNX file and the VietOCR ONNX directory
+        """
+        return cls._export_yolo_onnx(yolo_model_path), cls._export_ocr_onnx(yolo_model_path)
+    
+    @classmethod
+    def _export_yolo_onnx(cls, yolo_model_path: str) -> str:
+        yolo_path = Path(yolo_model_path)
+        onnx_path = yolo_path.with_suffix('.onnx')
+        if not onnx_path.exists() or onnx_path.stat().st_mtime_ns < yolo_path.stat().st_mtime_ns:
+            logger.info(f"Exporting {yolo_path} to ONNX")
+            onnx_path = Path(YOLO(yolo_model_path).export(
+                format='onnx', imgsz=cls.DETECTION_SIZE, dynamic=True, simplify=False, verbose=False))
+        return str(onnx_path)
+    
+    @classmethod
+    def _export_ocr_onnx(cls, yolo_model_path: str) -> str:
+        config = cls._ocr_config('cpu')
+        ocr_dir = Path(yolo_model_path).parent / cls.VIETOCR_ONNX_DIR
+        try:
+            fresh = read_onnx_meta(ocr_dir).get('source') == config['weights']
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            logger.info(f"Exporting VietOCR to {ocr_dir}")
+            export_onnx(Predictor(config).model, ocr_dir,
+                        image_height=config['dataset']['image_height'], source=config['weights'])
+        return str(ocr_dir)
+    
+    def quantize_ocr(self, calibration_dir: Optional[str] = None, calibration_stats: Optional[str] = None) -> None:
+        """
+        Switch VietOCR to INT8: dynamic quantization of the transformer's
+        Linear layers and static quantization of the VGG convolutions,
+        with activation ranges from calibration_stats or else calibrated on
+        the field crops of the scans in calibration_dir. Missing files fall
+        back to quantizing the Linear layers only.
+        
+        Args:
+            calibration_stats: File written by Predictor.calibration_stats
+                (optional)
+            calibration_dir: Directory of certificate scans (optional)
+        """
+        stats = None
+        if calibration_stats:
+            if Path(calibration_stats).is_file():
+                stats = torch.load(calibration_stats, map_location='cpu')
+                calibration_dir = None
+            else:
+                logger.warning(f"Calibration stats {calibration_stats} not found")
+                calibration_stats = None
+        
+        if calibration_dir and not Path(calibration_dir).is_dir():
+            logger.warning(f"Calibration directory {calibration_dir} not found")
+            calibration_dir = None
+        
+        crops = self.calibration_crops(calibration_dir) if calibration_dir else []
+        if calibration_dir and not crops:
+            logger.warning(f"No field crops in {calibration_dir}")
+            calibration_dir = None
+        if stats is None and not crops:
+            logger.warning("No INT8 calibration, quantizing the Linear layers only")
+        
+        self.ocr_predictor.quantize(crops, observer_stats=stats)
+        self.int8 = True
+        self.calibration_dir = calibration_dir
+        self.calibration_stats = calibration_stats
+        self._fingerprint = None
+        source = calibration_stats or f"{len(crops)} crops"
+        logger.info(f"Using INT8 OCR (calibrated on {source})")
+    
+    def calibration_crops(self, image_dir: str, max_images: int = 32) -> List[np.ndarray]:
+        """
+        Field crops of the certificate scans in image_dir
+        
+        Args:
+            image_dir: Directory of .jpg/.jpeg/.png scans
+            max_images: Maximum number of scans to use
+            
+        Returns:
+            RGB crops
+        """
+        paths = sorted(
+            path for path in Path(image_dir).iterdir()
+            if path.suffix.lower() in ('.jpg', '.jpeg', '.png')
+        )
+        return [crop for path in paths[:max_images] for crop in self.field_crops(path.read_bytes())]
+    
+    def field_crops(self, contents: bytes) -> List[np.ndarray]:
+        """
+        Crops of every selected field of an uploaded scan, the label boxes
+        (k_name, k_m_name, k_c_name) in extract_fields included
+        """
+        image = self.load_image(contents)
+        img_array = self.preprocess_image(image)
+        detections = self._to_full_resolution(
+            image, self.detect_fields(img_array, select_fields=True)
+        )
+        crops = self._crop_fields(image, img_array, detections)
+        return [crop for crop in crops if crop is not None]
+    
+    @staticmethod
+    def decode_image(contents: bytes, reduction: int = 1) -> np.ndarray:
+        """
+        Decode uploaded bytes once into an RGB uint8 array
+        
+        OpenCV decodes straight from the upload buffer; formats it cannot
+        read fall back to PIL. EXIF orientation is ignored, as with PIL.
+        
+        Args:
+            contents: Encoded image bytes
+            reduction: Decode at 1/reduction resolution (1, 2, 4 or 8),
+                using JPEG DCT scaling where possible
+            
+        Returns:
+            HxWx3 uint8 array in RGB format
+        """
+        flags = {
+            1: cv2.IMREAD_COLOR,
+            2: cv2.IMREAD_REDUCED_COLOR_2,
+            4: cv2.IMREAD_REDUCED_COLOR_4,
+            8: cv2.IMREAD_REDUCED_COLOR_8,
+        }[reduction]
+        
+        buffer = np.frombuffer(contents, dtype=np.uint8)
+        image = cv2.imdecode(buffer, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            with Image.open(io.BytesIO(contents)) as pil_image:
+                if reduction > 1:
+                    w, h = pil_image.size
+                    pil_image.draft('RGB', (w // reduction, h // reduction))
+                return np.asarray(pil_image.convert('RGB'))
+        
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    
+    def load_image(self, contents: bytes) -> ScanImage:
+        """Decode uploaded bytes once, at reduced resolution for large JPEGs with large enough text"""
+        return ScanImage(
+            contents,
+            self.DETECTION_SIZE,
+            min_text_height=self._min_text_height(),
+            text_height_ratio=self.text_height_ratio
+        )
+    
+    def _min_text_height(self) -> int:
+        """Crops are decoded at least twice as tall as VietOCR's input"""
+        return 2 * self.ocr_predictor.config['dataset']['image_height']
+    
+    def preprocess_image(self, image: Union[Image.Image, np.ndarray, ScanImage]) -> np.ndarray:
         """
         Preprocess image with validation
         
         Args:
-            image: PIL Image
+            image: PIL Image, an RGB uint8 array from decode_image (used as
+                is, without a copy) or a ScanImage from load_image
             
         Returns:
-            Numpy array in RGB format
+            Numpy array in RGB format, at detection resolution for a
+            ScanImage
         """
         if image is None:
             raise ValueError("Image cannot be None")
         
+        if isinstance(image, ScanImage):
+            return image.detection
+        
+        if isinstance(image, np.ndarray):
+            if image.ndim == 2:
+                return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+            if image.ndim != 3 or image.shape[2] != 3 or image.dtype != np.uint8:
+                raise ValueError(f"Expected an HxWx3 uint8 array, got {image.shape} {image.dtype}")
+            return image
+        
         # Convert to RGB if needed
         if image.mode != 'RGB':
             image = image.convert('RGB')
         
-        return np.array(image)
+        return np.asarray(image)
     
     def detect_fields(
         self, 
         image: np.ndarray,
-        conf_threshold: float = MIN_CONFIDENCE_THRESHOLD
+        conf_threshold: float = MIN_CONFIDENCE_THRESHOLD,
+        select_fields: bool = False
     ) -> List[Dict]:
         """
         Detect fields on birth certificate with confidence filtering
@@ -124,36 +541,23 @@ class OCRExtractor:
         Args:
             image: Input image array
             conf_threshold: Minimum confidence threshold
+            select_fields: Keep only fields in extract_fields and the
+                highest-confidence box per field, best first
             
         Returns:
             List of detected boxes with labels
         """
         try:
-            results = self.yolo_model.predict(
-                image, 
-                verbose=False,
-                conf=conf_threshold
-            )
+            with self._yolo_lock:
+                results = self.yolo_model.predict(
+                    image, 
+                    verbose=False,
+                    conf=conf_threshold
+                )
             
             detections = []
             for result in results:
-                boxes = result.boxes
-                if boxes is None:
-                    continue
-                    
-                for box in boxes:
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                    conf = float(box.conf[0])
-                    cls = int(box.cls[0])
-                    
-                    # Validate bbox
-                    if self._is_valid_bbox([x1, y1, x2, y2]):
-                        detections.append({
-                            'bbox': [int(x1), int(y1), int(x2), int(y2)],
-                            'confidence': conf,
-                            'class_id': cls,
-                            'field_name': self.class_mapping.get(cls, f'unknown_{cls}')
-                        })
+                detections.extend(self._parse_result(result, select_fields))
             
             return detections
             
@@ -161,10 +565,132 @@ class OCRExtractor:
             logger.error(f"Detection failed: {e}")
             return []
     
-    def _is_valid_bbox(self, bbox: List[float]) -> bool:
-        """Validate bounding box coordinates"""
+    def detect_fields_batch(
+        self,
+        images: List[np.ndarray],
+        conf_threshold: float = MIN_CONFIDENCE_THRESHOLD,
+        select_fields: bool = False
+    ) -> List[List[Dict]]:
+        """
+        Detect fields on several birth certificates with one YOLO call
+        
+        Args:
+            images: Input image arrays
+            conf_threshold: Minimum confidence threshold
+            select_fields: Keep only fields in extract_fields and the
+                highest-confidence box per field, best first
+            
+        Returns:
+            List of detected boxes with labels, one list per image
+        """
+        try:
+            with self._yolo_lock:
+                results = self.yolo_model.predict(
+                    images,
+                    verbose=False,
+                    conf=conf_threshold
+                )
+            return [self._parse_result(result, select_fields) for result in results]
+            
+        except Exception as e:
+            logger.error(f"Batched detection failed: {e}")
+            return [[] for _ in images]
+    
+    def _parse_result(self, result, select_fields: bool = False) -> List[Dict]:
+        """
+        Convert one YOLO result into detection dictionaries
+        
+        All boxes are copied to host in one transfer and validated, filtered
+        and deduplicated as whole arrays.
+        """
+        boxes = result.boxes
+        if boxes is None or len(boxes) == 0:
+            return []
+        
+        data = boxes.data.cpu().numpy()
+        xyxy = data[:, :4]
+        conf = data[:, -2]
+        cls = data[:, -1].astype(int)
+        
+        # Validate bboxes
+        keep = (
+            (xyxy[:, 2] > xyxy[:, 0])
+            & (xyxy[:, 3] > xyxy[:, 1])
+            & (xyxy >= 0).all(axis=1)
+        )
+        
+        if select_fields:
+            # Filter by extract_fields if specified
+            keep &= self._field_mask(cls)
+        
+        idx = np.flatnonzero(keep)
+        
+        if select_fields:
+            # Keep the highest-confidence box per field, sorted by confidence
+            idx = idx[np.argsort(-conf[idx], kind='stable')]
+            _, first = np.unique(cls[idx], return_index=True)
+            idx = idx[np.sort(first)]
+        
+        bboxes = xyxy[idx].astype(int).tolist()
+        return [
+            {
+                'bbox': bbox,
+                'confidence': float(conf[i]),
+                'class_id': int(cls[i]),
+                'field_name': self.class_mapping.get(int(cls[i]), f'unknown_{cls[i]}')
+            }
+            for i, bbox in zip(idx, bboxes)
+        ]
+    
+    def _field_mask(self, cls: np.ndarray) -> np.ndarray:
+        """Boolean mask of class ids whose field is in extract_fields"""
+        if not self.extract_fields:
+            return np.ones(len(cls), dtype=bool)
+        
+        allowed = [
+            c for c in np.unique(cls)
+            if self.class_mapping.get(int(c), f'unknown_{c}') in self.extract_fields
+        ]
+        return np.isin(cls, allowed)
+    
+    def _crop(
+        self,
+        image: np.ndarray,
+        bbox: List[int],
+        padding: int = DEFAULT_PADDING
+    ) -> Optional[np.ndarray]:
+        """
+        Crop a padded region, or None if the crop is empty
+        
+        The crop is a view into image; VietOCR resizes it without copying
+        the region first.
+        
+        Args:
+            image: Original image
+            bbox: [x1, y1, x2, y2]
+            padding: Padding around bbox
+            
+        Returns:
+            Cropped array view or None
+        """
         x1, y1, x2, y2 = bbox
-        return x2 > x1 and y2 > y1 and all(coord >= 0 for coord in bbox)
+        h, w = image.shape[:2]
+        
+        # Apply padding with boundary checks
+        x1 = max(0, x1 - padding)
+        y1 = max(0, y1 - padding)
+        x2 = min(w, x2 + padding)
+        y2 = min(h, y2 + padding)
+        
+        # Crop image
+        cropped = image[y1:y2, x1:x2]
+        
+        # Validate crop
+        if cropped.size == 0:
+            logger.warning(f"Empty crop for bbox: {bbox}")
+            return None
+        
+        return cropped
     
     def crop_and_ocr(
         self, 
@@ -184,37 +710,194 @@ class OCRExtractor:
             Extracted text
         """
         try:
-            x1, y1, x2, y2 = bbox
-            h, w = image.shape[:2]
-            
-            # Apply padding with boundary checks
-            x1 = max(0, x1 - padding)
-            y1 = max(0, y1 - padding)
-            x2 = min(w, x2 + padding)
-            y2 = min(h, y2 + padding)
-            
-            # Crop image
-            cropped = image[y1:y2, x1:x2]
-            
-            # Validate crop
-            if cropped.size == 0:
-                logger.warning(f"Empty crop for bbox: {bbox}")
+            cropped = self._crop(image, bbox, padding)
+            if cropped is None:
                 return ""
             
-            # Convert to PIL Image (avoid unnecessary conversion if possible)
-            if not isinstance(cropped, Image.Image):
-                cropped_pil = Image.fromarray(cropped)
-            else:
-                cropped_pil = cropped
-            
             # Perform OCR
-            text = self.ocr_predictor.predict(cropped_pil)
+            text = self.ocr_predictor.predict(cropped)
             return text.strip()
             
         except Exception as e:
             logger.error(f"OCR failed for bbox {bbox}: {e}")
             return ""
     
+    def _crop_fields(
+        self,
+        image: Union[Image.Image, np.ndarray, ScanImage],
+        img_array: np.ndarray,
+        detections: List[Dict]
+    ) -> List[Optional[np.ndarray]]:
+        """
+        Crop the detections to read
+        
+        Boxes are in full-resolution coordinates. For a ScanImage the crops
+        come from its decode (see ScanImage.recognition_image).
+        """
+        if not isinstance(image, ScanImage):
+            return [self._crop(img_array, detection['bbox']) for detection in detections]
+        
+        if not detections:
+            return []
+        
+        bboxes = [detection['bbox'] for detection in detections]
+        
+        source, reduction = image.recognition_image(bboxes)
+        return [
+            self._crop(source, [int(round(v / reduction)) for v in bbox])
+            for bbox in bboxes
+        ]
+    
+    def _to_full_resolution(
+        self,
+        image: Union[Image.Image, np.ndarray, ScanImage],
+        detections: List[Dict]
+    ) -> List[Dict]:
+        """Map detection boxes of a ScanImage back to full resolution"""
+        if isinstance(image, ScanImage):
+            for detection in detections:
+                detection['bbox'] = image.to_full_resolution(detection['bbox'])
+        return detections
+    
+    def _ocr_crops(self, crops: List[Optional[np.ndarray]]) -> List[Tuple[str, List[float]]]:
+        """
+        Recognize crops in one width-padded batch
+        
+        Returns:
+            (text, per-character probabilities) per crop, ("", []) for
+            missing crops or on failure
+        """
+        readings = [("", [])] * len(crops)
+        try:
+            kept = [i for i, crop in enumerate(crops) if crop is not None]
+            if not kept:
+                return readings
+            
+            # Perform OCR
+            texts, _, char_probs = self.ocr_predictor.predict_batch(
+                [crops[i] for i in kept], pad_width=True, return_char_probs=True
+            )
+            for i, text, probs in zip(kept, texts, char_probs):
+                # Strip the text and its probabilities together
+                start = len(text) - len(text.lstrip())
+                end = len(text.rstrip())
+                readings[i] = (text[start:end], probs[start:end])
+            return readings
+            
+        except Exception as e:
+            logger.error(f"Batched OCR failed for {len(crops)} crops: {e}")
+            return readings
+    
+    def _read_fields(
+        self,
+        image: Union[Image.Image, np.ndarray, ScanImage],
+        img_array: np.ndarray,
+        detections: List[Dict],
+        min_confidence: Optional[float] = None
+    ) -> Tuple[List[Optional[np.ndarray]], List[bool]]:
+        """
+        Crop the detections to read, skipping output fields whose detection
+        confidence is already below min_confidence
+        
+        Returns:
+            Crops of the fields to recognize and a skip flag per detection
+        """
+        skipped = [
+            min_confidence is not None
+            and self._is_output_field(detection['field_name'])
+            and detection['confidence'] < min_confidence
+            for detection in detections
+        ]
+        to_crop = [detection for detection, skip in zip(detections, skipped) if not skip]
+        return self._crop_fields(image, img_array, to_crop), skipped
+    
+    @staticmethod
+    def _with_skipped(
+        readings: List[Tuple[str, List[float]]],
+        skipped: List[bool]
+    ) -> List[Optional[Tuple[str, List[float]]]]:
+        """Put None back in place of skipped detections"""
+        readings = iter(readings)
+        return [None if skip else next(readings) for skip in skipped]
+    
+    @staticmethod
+    def _sequence_confidence(char_probs: List[float]) -> float:
+        """Geometric mean of the character probabilities"""
+        if not char_probs:
+            return 0.0
+        return float(np.exp(np.mean(np.log(np.clip(char_probs, 1e-12, None)))))
+    
+    def calibrate_confidence(self, field_score: float) -> float:
+        """
+        Map a field score to the probability that the field is read right
+        
+        Platt scaling of the score's log-odds with confidence_calibration;
+        the score itself if no calibration is configured.
+        """
+        if self.confidence_calibration is None:
+            return field_score
+        slope, intercept = self.confidence_calibration
+        score = min(max(field_score, 1e-6), 1 - 1e-6)
+        logit = slope * np.log(score / (1 - score)) + intercept
+        return float(1 / (1 + np.exp(-logit)))
+    
+    @staticmethod
+    def fit_confidence_calibration(
+        field_scores: List[float],
+        correct: List[bool],
+        iterations: int = 50
+    ) -> Tuple[float, float]:
+        """
+        Fit confidence_calibration on reviewed results
+        
+        Logistic regression of whether each field was read correctly on the
+        log-odds of its field_score, solved with Newton's method.
+        
+        Args:
+            field_scores: field_score of each reviewed field
+            correct: Whether the field's value was correct
+            iterations: Maximum number of Newton steps
+            
+        Returns:
+            (slope, intercept) for the confidence_calibration argument
+        """
+        scores = np.clip(np.asarray(field_scores, dtype=np.float64), 1e-6, 1 - 1e-6)
+        x = np.stack([np.log(scores / (1 - scores)), np.ones_like(scores)], axis=1)
+        y = np.asarray(correct, dtype=np.float64)
+        
+        params = np.array([1.0, 0.0])
+        for _ in range(iterations):
+            p = 1 / (1 + np.exp(-x @ params))
+            gradient = x.T @ (p - y)
+            # a small ridge term keeps separable data from diverging
+            hessian = x.T @ (x * (p * (1 - p))[:, None]) + 1e-3 * np.eye(2)
+            step = np.linalg.solve(hessian, gradient + 1e-3 * (params - [1.0, 0.0]))
+            params -= step
+            if np.abs(step).max() < 1e-8:
+                break
+        return float(params[0]), float(params[1])
+    
+    @staticmethod
+    def mark_for_review(extracted_info: Dict, min_confidence: float) -> Dict:
+        """
+        Flag fields whose field confidence is below min_confidence
+        
+        Args:
+            extracted_info: Extraction result
+            min_confidence: Minimum field confidence
+            
+        Returns:
+            Copy of extracted_info with a needs_review flag per field
+        """
+        return {
+            field_name: {
+                **info,
+                'needs_review': info.get('field_confidence') is None
+                or info['field_confidence'] < min_confidence,
+            }
+            for field_name, info in extracted_info.items()
+        }
+    
     @staticmethod
     @lru_cache(maxsize=128)
     def _normalize_name(name: str) -> str:
@@ -288,42 +971,118 @@ class OCRExtractor:
         
         return word_count == 4 or has_mother_keyword
     
-    def swap_parent_fields(self, extracted_info: Dict) -> Dict:
+    def swap_parent_fields(self, extracted_info: Dict, swap: Optional[bool] = None) -> Dict:
         """
         Swap father and mother fields if needed
         
         Args:
             extracted_info: Extracted information dictionary
+            swap: Decision made from box geometry, if any. If None, it is
+                taken from the k_c_name text
             
         Returns:
             Updated dictionary with swapped fields if necessary
         """
-        if not self._should_swap_parent_fields(extracted_info):
+        if swap is None:
+            swap = self._should_swap_parent_fields(extracted_info)
+        
+        if not swap:
             return extracted_info
         
-        mother_key = 'Họ và tên Mẹ'
-        father_key = 'Họ và tên Cha'
+        mother_key = self.MOTHER_FIELD
+        father_key = self.FATHER_FIELD
         
         if mother_key in extracted_info and father_key in extracted_info:
             # Swap all attributes
             extracted_info[mother_key], extracted_info[father_key] = \
                 extracted_info[father_key], extracted_info[mother_key]
             
-            logger.info("Swapped parent fields based on k_c_name")
+            logger.info("Swapped parent fields")
         
         return extracted_info
     
+    def _is_output_field(self, field_name: str) -> bool:
+        """Whether a field is part of the extraction result"""
+        return self.return_labels or field_name not in self.LABEL_FIELDS
+    
+    def plan_fields(self, detections: List[Dict]) -> Tuple[List[Dict], Optional[bool]]:
+        """
+        Decide which detections need OCR
+        
+        Output fields are always read. Label boxes are only read when the
+        parent swap rule needs their text: both parent fields are detected
+        and the box geometry does not settle the swap on its own.
+        
+        Args:
+            detections: Selected detections, one per field
+            
+        Returns:
+            Detections to recognize and the swap decision (None if it
+            depends on the k_c_name text)
+        """
+        by_field = {detection['field_name']: detection for detection in detections}
+        to_read = [d for d in detections if self._is_output_field(d['field_name'])]
+        
+        if self.MOTHER_FIELD not in by_field or self.FATHER_FIELD not in by_field:
+            return to_read, False
+        
+        if self._swap_from_geometry(by_field):
+            return to_read, True
+        
+        label = by_field.get('k_c_name')
+        if label is None:
+            return to_read, False
+        
+        if not self._is_output_field('k_c_name'):
+            to_read.append(label)
+        return to_read, None
+    
+    def _swap_from_geometry(self, by_field: Dict[str, Dict]) -> bool:
+        """
+        Detect a parent swap from box positions alone
+        
+        A label sits on the same row as its value. If the father label
+        (k_c_name) is aligned with the mother value, the parent values are
+        swapped. Only k_c_name is used, like the text rule: without it the
+        text rule never swaps. An aligned, consistent layout proves nothing
+        about the label text, so it returns False and leaves the decision
+        to the text rule.
+        """
+        label = by_field.get('k_c_name')
+        if label is None:
+            return False
+        
+        own = self._row_overlap(label['bbox'], by_field[self.FATHER_FIELD]['bbox'])
+        other = self._row_overlap(label['bbox'], by_field[self.MOTHER_FIELD]['bbox'])
+        return other >= self.MIN_ROW_OVERLAP and other > own
+    
+    @staticmethod
+    def _row_overlap(a: List[int], b: List[int]) -> float:
+        """Vertical overlap of two boxes relative to the shorter one"""
+        overlap = min(a[3], b[3]) - max(a[1], b[1])
+        shorter = min(a[3] - a[1], b[3] - b[1])
+        return max(0, overlap) / shorter if shorter > 0 else 0.0
+    
     def extract_info(
         self, 
-        image: Image.Image,
-        return_visualization: bool = False
+        image: Union[Image.Image, np.ndarray, ScanImage],
+        return_visualization: bool = False,
+        min_confidence: Optional[float] = None
     ) -> Dict:
         """
         Extract complete information from birth certificate
         
+        Every field carries the detection confidence, the recognition
+        confidence (per character and for the whole text, from the same
+        decoding pass) and their product as field confidence.
+        
         Args:
-            image: Input PIL Image
+            image: Input PIL Image, RGB array from decode_image or
+                ScanImage from load_image
             return_visualization: If True, return annotated image
+            min_confidence: If set, output fields whose detection
+                confidence is already below it are not recognized (value
+                None); see mark_for_review
             
         Returns:
             Dictionary of extracted information
@@ -333,48 +1092,21 @@ class OCRExtractor:
             img_array = self.preprocess_image(image)
             
             # Detect fields
-            detections = self.detect_fields(img_array)
+            detections = self._to_full_resolution(
+                image, self.detect_fields(img_array, select_fields=True)
+            )
             
             if not detections:
                 logger.warning("No fields detected")
                 return {}
             
-            # Sort by confidence (descending)
-            detections.sort(key=lambda x: x['confidence'], reverse=True)
+            to_read, swap = self.plan_fields(detections)
             
-            # Extract text from each field
-            extracted_info = {}
-            seen_fields = set()
+            # Perform OCR on all fields at once
+            crops, skipped = self._read_fields(image, img_array, to_read, min_confidence)
+            readings = self._with_skipped(self._ocr_crops(crops), skipped)
             
-            for detection in detections:
-                field_name = detection['field_name']
-                
-                # Filter by extract_fields if specified
-                if self.extract_fields and field_name not in self.extract_fields:
-                    continue
-                
-                # Skip duplicate fields (keep highest confidence)
-                if field_name in seen_fields:
-                    continue
-                
-                seen_fields.add(field_name)
-                bbox = detection['bbox']
-                
-                # Perform OCR
-                text = self.crop_and_ocr(img_array, bbox)
-                
-                # Post-process
-                text = self.post_process_text(field_name, text)
-                
-                if text:  # Only save non-empty results
-                    extracted_info[field_name] = {
-                        'value': text,
-                        'confidence': detection['confidence'],
-                        'bbox': bbox
-                    }
-            
-            # Swap parent fields if needed
-            extracted_info = self.swap_parent_fields(extracted_info)
+            extracted_info = self._build_info(to_read, readings, swap)
             
             logger.info(f"Extracted {len(extracted_info)} fields")
             return extracted_info
@@ -383,20 +1115,134 @@ class OCRExtractor:
             logger.error(f"Extraction failed: {e}")
             return {}
     
-    def batch_extract(self, images: List[Image.Image]) -> List[Dict]:
+    def _build_info(
+        self,
+        detections: List[Dict],
+        readings: List[Optional[Tuple[str, List[float]]]],
+        swap: Optional[bool] = None
+    ) -> Dict:
+        """Post-process recognized texts into the extraction result"""
+        extracted_info = {}
+        for detection, reading in zip(detections, readings):
+            field_name = detection['field_name']
+            
+            # Skipped below min_confidence: keep the detection for review
+            if reading is None:
+                extracted_info[field_name] = {
+                    'value': None,
+                    'confidence': detection['confidence'],
+                    'bbox': detection['bbox'],
+                    'raw_value': None,
+                    'char_confidences': [],
+                    'ocr_confidence': None,
+                    'field_score': None,
+                    'field_confidence': None,
+                }
+                continue
+            
+            raw_text, char_probs = reading
+            
+            # Post-process
+            text = self.post_process_text(field_name, raw_text)
+            
+            if text:  # Only save non-empty results
+                ocr_confidence = self._sequence_confidence(char_probs)
+                # heuristic: detection times recognition confidence
+                field_score = detection['confidence'] * ocr_confidence
+                extracted_info[field_name] = {
+                    'value': text,
+                    'confidence': detection['confidence'],
+                    'bbox': detection['bbox'],
+                    'raw_value': raw_text,
+                    'char_confidences': [round(p, 4) for p in char_probs],
+                    'ocr_confidence': ocr_confidence,
+                    'field_score': field_score,
+                    'field_confidence': self.calibrate_confidence(field_score),
+                }
+        
+        # Swap parent fields if needed
+        extracted_info = self.swap_parent_fields(extracted_info, swap)
+        
+        # Drop labels that were only read for routing
+        return {
+            field_name: info for field_name, info in extracted_info.items()
+            if self._is_output_field(field_name)
+        }
+    
+    def batch_extract(
+        self,
+        images: List[Union[Image.Image, np.ndarray, ScanImage]],
+        min_confidence: Union[None, float, List[Optional[float]]] = None
+    ) -> List[Dict]:
         """
         Extract information from multiple images
         
+        Images are processed in chunks of batch_size: YOLO runs once per
+        chunk and every field crop of the chunk is recognized in a single
+        batched VietOCR pass.
+        
         Args:
-            images: List of PIL Images
+            images: List of PIL Images, RGB arrays from decode_image or
+                ScanImages from load_image
+            min_confidence: See extract_info; one value for all images or
+                one per image
             
         Returns:
-            List of extraction results
+            List of extraction results, in input order
         """
+        if not isinstance(min_confidence, list):
+            min_confidence = [min_confidence] * len(images)
+        
+        results = []
+        batch_size = max(1, self.batch_size)
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            thresholds = min_confidence[start:start + batch_size]
+            try:
+                results.extend(self._extract_chunk(chunk, thresholds))
+            except Exception as e:
+                logger.error(f"Batch extraction failed, retrying per image: {e}")
+                results.extend(
+                    self.extract_info(img, min_confidence=threshold)
+                    for img, threshold in zip(chunk, thresholds)
+                )
+        return results
+    
+    def _extract_chunk(
+        self,
+        images: List[Union[Image.Image, np.ndarray, ScanImage]],
+        min_confidence: List[Optional[float]]
+    ) -> List[Dict]:
+        """Run detection and recognition for one chunk of images"""
+        arrays = [self.preprocess_image(img) for img in images]
+        
+        # Detect fields
+        detections_per_image = self.detect_fields_batch(arrays, select_fields=True)
+        
+        # Collect the crops of every image for one recognition pass
+        plans = []
+        crops = []
+        for image, img_array, detections, threshold in zip(images, arrays, detections_per_image, min_confidence):
+            detections = self._to_full_resolution(image, detections)
+            to_read, swap = self.plan_fields(detections)
+            image_crops, skipped = self._read_fields(image, img_array, to_read, threshold)
+            plans.append((detections, to_read, swap, skipped, threshold))
+            crops.extend(image_crops)
+        
+        readings = self._ocr_crops(crops)
+        
         results = []
-        for img in images:
-            result = self.extract_info(img)
-            results.append(result)
+        offset = 0
+        for detections, to_read, swap, skipped, threshold in plans:
+            if not detections:
+                logger.warning("No fields detected")
+            count = skipped.count(False)
+            image_readings = self._with_skipped(readings[offset:offset + count], skipped)
+            extracted_info = self._build_info(to_read, image_readings, swap)
+            offset += count
+            results.append(extracted_info)
+        
+        logger.info(f"Extracted {sum(len(r) for r in results)} fields from {len(images)} images")
         return results
     
     def __del__(self):
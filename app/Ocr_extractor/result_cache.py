@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    Content-addressed cache of extraction results
+
+    Entries are keyed by a hash of the uploaded bytes and the extractor's
+    fingerprint, so a re-submitted scan is answered without running the
+    models while a model or config change never serves stale results.
+    The in-memory store is bounded by max_entries (least recently used
+    entries are evicted first) and entries expire after ttl_seconds.
+    With persist_dir set, entries are also written as JSON files and
+    survive restarts. The directory is swept at most every
+    sweep_interval_seconds when entries are added: expired files are
+    deleted, then the oldest ones beyond max_disk_entries.
+
+    get() and put() may touch the disk, so async callers should run them
+    in a thread pool when persist_dir is set; get_memory() never does and
+    can be called directly, leaving only get_disk() for the thread pool.
+    The lock only guards the in-memory store.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: Optional[float] = 3600,
+        persist_dir: Optional[str] = None,
+        max_disk_entries: Optional[int] = 10000,
+        sweep_interval_seconds: float = 60
+    ):
+        """
+        Args:
+            max_entries: Maximum number of results kept in memory
+            ttl_seconds: Lifetime of an entry, None for no expiry
+            persist_dir: Directory for on-disk entries (optional)
+            max_disk_entries: Maximum number of on-disk entries, None for
+                no limit
+            sweep_interval_seconds: Minimum time between two sweeps of
+                persist_dir
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_dir = Path(persist_dir) if persist_dir else None
+        self.max_disk_entries = max_disk_entries
+        self.sweep_interval = sweep_interval_seconds
+
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._last_sweep = 0.0
+
+        if self.persist_dir is not None:
+            self.persist_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(contents: bytes, version: str = "") -> str:
+        """Hash uploaded bytes together with the model/config version"""
+        digest = hashlib.sha256(contents)
+        digest.update(version.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the cached result for key, or None on a miss"""
+        result = self.get_memory(key)
+        if result is None and self.persist_dir is not None:
+            result = self.get_disk(key)
+        return result
+
+    def get_memory(self, key: str) -> Optional[Dict]:
+        """
+        Return the result for key from the in-memory store, or None
+
+        Without persist_dir this is a full lookup. Otherwise a None result
+        is not counted as a miss yet; follow it with get_disk().
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0], now):
+                del self._entries[key]
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if self.persist_dir is None:
+                self.misses += 1
+            return None
+
+    def get_disk(self, key: str) -> Optional[Dict]:
+        """Return the result for key from persist_dir, or None on a miss"""
+        now = time.time()
+        # Disk lookups run outside the lock so they never block other requests
+        entry = self._load(key, now)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._store(key, entry)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, result: Dict) -> None:
+        """Cache a result"""
+        entry = (time.time(), result)
+        with self._lock:
+            self._store(key, entry)
+
+        if self.persist_dir is not None:
+            self._save(key, entry)
+            self._maybe_sweep(entry[0])
+
+    def sweep(self) -> int:
+        """
+        Delete expired on-disk entries, then the oldest beyond max_disk_entries
+
+        Returns:
+            Number of files deleted
+        """
+        if self.persist_dir is None:
+            return 0
+
+        now = time.time()
+        files = []
+        for path in self.persist_dir.glob('*.json'):
+            try:
+                files.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue
+
+        # Entries are written once, so the file time is the creation time
+        files.sort()
+        expired = [path for mtime, path in files if self._expired(mtime, now)]
+        fresh = [path for mtime, path in files if not self._expired(mtime, now)]
+        stale = expired
+        if self.max_disk_entries is not None and len(fresh) > self.max_disk_entries:
+            stale = expired + fresh[:len(fresh) - self.max_disk_entries]
+
+        for path in stale:
+            path.unlink(missing_ok=True)
+        if stale:
+            logger.info(f"Removed {len(stale)} result cache files from {self.persist_dir}")
+        return len(stale)
+
+    def _maybe_sweep(self, now: float) -> None:
+        with self._lock:
+            if now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+        try:
+            self.sweep()
+        except OSError as e:
+            logger.warning(f"Failed to sweep {self.persist_dir}: {e}")
+
+    def clear(self) -> None:
+        """Drop all in-memory entries and reset counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created > self.ttl_seconds
+
+    def _store(self, key: str, entry: Tuple[float, Dict]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key: str) -> Path:
+        return self.persist_dir / f"{key}.json"
+
+    def _load(self, key: str, now: float) -> Optional[Tuple[float, Dict]]:
+        if self.persist_dir is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+        if self._expired(data['created'], now):
+            path.unlink(missing_ok=True)
+            return None
+        return data['created'], data['result']
+
+    def _save(self, key: str, entry: Tuple[float, Dict]) -> None:
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'created': entry[0], 'result': entry[1]}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Failed to persist cache entry {path}: {e}")
+            tmp_path.unlink(missing_ok=True)
@@ -1,10 +1,10 @@
 from fastapi import FastAPI
-from .routers.development.basic_router import basic_router
+from .routers.development.basic_router import basic_router, scheduler, EXTRACTOR_CONFIG
 
 import time 
 from .core.middle_ware.timer_middleware import TimerMiddleware
-from app.Ocr_extractor.ocr_extractor import OCRExtractor
-from app.core.config.constants import YOLO_MODEL, YOLO_LOCAL
+from app.Ocr_extractor.model_registry import model_registry
+from app.core.config.constants import LAZY_MODEL_LOADING
 
 tags_metadata = [
     {
@@ -19,13 +19,17 @@ app = FastAPI(openapi_tags=tags_metadata)
 app.include_router(basic_router, tags=["OCR"])
 
 app.add_middleware(TimerMiddleware)
-extractor = None
+
 @app.on_event("startup")
 async def startup_event():
     start = time.perf_counter()
-    global extractor
-    # Thay đổi đường dẫn này
-    # extractor = OCRExtractor(yolo_model_path="/home/admin1/Code/ocr_khai_sinh/app/model_yolov11/best.pt")
-    extractor = OCRExtractor(yolo_model_path=YOLO_MODEL)
+    # Load model một lần, dùng chung cho mọi route (trừ khi load lazy)
+    if not LAZY_MODEL_LOADING:
+        model_registry.get(EXTRACTOR_CONFIG)
+    scheduler.start()
     end = time.perf_counter()
-    print(f"Startup event took {end - start} seconds")
\ No newline at end of file
+    print(f"Startup event took {end - start} seconds")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    scheduler.stop()
@@ -1,2 +1,51 @@
 YOLO_MODEL = "/workspace/app/model_yolov11/best.pt"
-YOLO_LOCAL = "/home/admin1/Code/ocr_khai_sinh/app/model_yolov11/best.pt"
\ No newline at end of file
+YOLO_LOCAL = "/home/admin1/Code/ocr_khai_sinh/app/model_yolov11/best.pt"
+
+# Fields returned by /extract (labels are only used to route parent fields)
+EXTRACT_FIELDS = {'Họ và tên Mẹ', 'k_c_name', 'k_m_name', 'Họ và tên Cha', 'Họ và tên'}
+
+# Re-read crops with beam search when the greedy mean char probability is lower
+OCR_BEAM_THRESHOLD = 0.8
+
+# Inference backend: 'torch', or 'onnx' for ONNX Runtime on CPU-only nodes
+INFERENCE_BACKEND = 'torch'
+# ONNX Runtime threads per operator (0: the worker's torch thread count) and
+# for independent operators (0 or 1: sequential execution)
+ONNX_INTRA_OP_THREADS = 0
+ONNX_INTER_OP_THREADS = 0
+
+# Run VietOCR in INT8 on CPU. The convolutions use activation ranges
+# calibrated offline (python -m app.int8_report --save-stats PATH), or
+# calibrate at start up on certificate scans mounted at INT8_CALIBRATION_DIR.
+# Neither set: only the Linear layers are quantized
+OCR_INT8 = False
+INT8_CALIBRATION_STATS = None
+INT8_CALIBRATION_DIR = None
+
+# (slope, intercept) turning field_score into a calibrated field_confidence,
+# fitted on reviewed results with OCRExtractor.fit_confidence_calibration.
+# None: field_confidence is the uncalibrated field_score
+FIELD_CONFIDENCE_CALIBRATION = None
+
+# Expected height of the smallest field relative to the scan height; large
+# JPEGs are then decoded at 1/2, 1/4 or 1/8 size when fields stay readable.
+# None: always decode at full resolution
+SCAN_TEXT_HEIGHT_RATIO = None
+
+# Load models on the first request instead of at startup
+LAZY_MODEL_LOADING = False
+
+# Micro-batching of /extract requests
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_MS = 10
+
+# Inference worker threads and admission control for /extract
+INFERENCE_WORKERS = 1
+MAX_QUEUED_REQUESTS = 64
+RETRY_AFTER_SECONDS = 1
+
+# Cache of /extract results keyed by the uploaded bytes
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL_SECONDS = 3600
+RESULT_CACHE_DIR = None
+RESULT_CACHE_DISK_SIZE = 10000
@@ -0,0 +1,77 @@
+"""
+Accuracy and cost of INT8 VietOCR against fp32 on real certificates
+
+    python -m app.int8_report --images bronze_bvcare_birth_cert_raw
+
+Field crops are cut from the scans with the YOLO detector. The first
+--calibration scans calibrate the INT8 convolutions, the others are read
+by both models; the report gives the share of identical texts, the
+character error rate of INT8 against fp32, the confidence change, CPU
+time per crop and model size.
+
+With --save-stats the calibrated activation ranges are also written, for
+INT8_CALIBRATION_STATS: workers then quantize without the scans.
+"""
+
+import argparse
+import copy
+import json
+import logging
+from pathlib import Path
+
+import torch
+
+from app.core.config.constants import YOLO_MODEL, EXTRACT_FIELDS
+from app.Ocr_extractor.ocr_extractor import OCRExtractor
+from app.vietocr.vietocr.tool.quantize import accuracy_report
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare INT8 and fp32 VietOCR on certificate scans")
+    parser.add_argument("--images", required=True, help="directory of certificate scans")
+    parser.add_argument("--calibration", type=int, default=4,
+                        help="number of scans used for calibration, the rest is evaluated")
+    parser.add_argument("--save-stats", default=None,
+                        help="write the calibrated activation ranges to this file")
+    parser.add_argument("--yolo-model", default=YOLO_MODEL)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads, default: all cores")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    extractor = OCRExtractor(yolo_model_path=args.yolo_model, extract_fields=EXTRACT_FIELDS)
+    if extractor.device != 'cpu':
+        raise SystemExit("INT8 quantization runs on CPU only")
+
+    paths = sorted(
+        path for path in Path(args.images).iterdir()
+        if path.suffix.lower() in ('.jpg', '.jpeg', '.png')
+    )
+    calibration, evaluation = [], []
+    for i, path in enumerate(paths):
+        (calibration if i < args.calibration else evaluation).extend(extractor.field_crops(path.read_bytes()))
+    if not evaluation:
+        raise SystemExit(f"No crops left to evaluate after {args.calibration} calibration scans")
+
+    reference = extractor.ocr_predictor
+    stats = reference.calibration_stats(calibration)
+    if args.save_stats:
+        torch.save(stats, args.save_stats)
+        logger.info(f"Saved calibration stats to {args.save_stats}")
+    quantized = copy.deepcopy(reference)
+    quantized.quantize(observer_stats=stats)
+
+    report = accuracy_report(reference, quantized, evaluation)
+    report['calibration_crops'] = len(calibration)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,97 @@
 from fastapi import APIRouter
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Query
+from fastapi.responses import JSONResponse, Response
+import asyncio
 import uvicorn
 from PIL import Image
 import io
 import numpy as np
-from app.Ocr_extractor.ocr_extractor import OCRExtractor
+from typing import Optional
+from app.Ocr_extractor.ocr_extractor import OCRExtractor, ScanImage
+from app.Ocr_extractor.batch_scheduler import BatchScheduler, QueueFullError, Reservation
+from app.Ocr_extractor.result_cache import ResultCache
+from app.core.config.constants import (
+    BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS,
+    INFERENCE_WORKERS, MAX_QUEUED_REQUESTS, RETRY_AFTER_SECONDS,
+    RESULT_CACHE_SIZE, RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_DIR, RESULT_CACHE_DISK_SIZE,
+)
+from app.Ocr_extractor.model_registry import model_registry
+from app.core.config.constants import YOLO_MODEL, EXTRACT_FIELDS, OCR_BEAM_THRESHOLD
+from app.core.config.constants import INFERENCE_BACKEND, ONNX_INTRA_OP_THREADS, ONNX_INTER_OP_THREADS
+from app.core.config.constants import OCR_INT8, INT8_CALIBRATION_DIR, INT8_CALIBRATION_STATS, FIELD_CONFIDENCE_CALIBRATION
+from app.core.config.constants import SCAN_TEXT_HEIGHT_RATIO
 from fastapi import FastAPI, File, UploadFile
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from functools import partial
 from PIL import Image
 import io
 
-extractor = OCRExtractor(extract_fields={'Họ và tên Mẹ', 'k_c_name', 'k_m_name', 'Họ và tên Cha','Họ và tên'})
+# Một OCRExtractor dùng chung cho mọi route, do model_registry quản lý
+EXTRACTOR_CONFIG = {
+    'yolo_model_path': YOLO_MODEL,
+    'extract_fields': EXTRACT_FIELDS,
+    'batch_size': BATCH_MAX_SIZE,
+    'beam_threshold': OCR_BEAM_THRESHOLD,
+    'backend': INFERENCE_BACKEND,
+    'intra_op_threads': ONNX_INTRA_OP_THREADS,
+    'inter_op_threads': ONNX_INTER_OP_THREADS,
+    'use_int8': OCR_INT8,
+    'calibration_dir': INT8_CALIBRATION_DIR,
+    'calibration_stats': INT8_CALIBRATION_STATS,
+    'confidence_calibration': FIELD_CONFIDENCE_CALIBRATION,
+    'text_height_ratio': SCAN_TEXT_HEIGHT_RATIO,
+}
+
+# Gom các request đồng thời thành micro-batch, chạy model ngoài event loop
+# Hàng đợi có giới hạn: đầy thì trả 503 + Retry-After thay vì xếp hàng vô hạn
+scheduler = BatchScheduler(
+    partial(model_registry.get, EXTRACTOR_CONFIG),
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    max_queue_size=MAX_QUEUED_REQUESTS,
+    num_workers=INFERENCE_WORKERS,
+)
+
+# Mã trạng thái khi client đã ngắt kết nối (theo quy ước của nginx)
+CLIENT_CLOSED_REQUEST = 499
+
+# Cache kết quả theo nội dung file, gắn với phiên bản model/config
+# Cache trên đĩa (nếu có) được đọc/ghi trong thread pool, không chặn event loop
+result_cache = ResultCache(
+    max_entries=RESULT_CACHE_SIZE,
+    ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+    persist_dir=RESULT_CACHE_DIR,
+    max_disk_entries=RESULT_CACHE_DISK_SIZE,
+)
+
+
+async def get_extractor() -> OCRExtractor:
+    """Extractor dùng chung; nếu chưa load thì load model ngoài event loop"""
+    extractor = model_registry.get_loaded(EXTRACTOR_CONFIG)
+    if extractor is None:
+        extractor = await run_in_threadpool(model_registry.get, EXTRACTOR_CONFIG)
+    return extractor
+
+
+async def submit_unless_disconnected(
+    request: Request,
+    image: ScanImage,
+    min_confidence: Optional[float] = None,
+    reservation: Optional[Reservation] = None,
+):
+    """
+    Chờ kết quả từ scheduler; nếu client ngắt kết nối thì huỷ request để
+    scheduler bỏ qua, trả về None
+    """
+    task = asyncio.ensure_future(scheduler.submit(image, min_confidence, reservation))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=0.1)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            return None
 
 basic_router = APIRouter()
 
@@ -21,10 +101,24 @@ basic_router = APIRouter()
 async def health_check():
     return {"status": "ok"}
 
+@basic_router.get("/cache/stats", tags=["OCR"])
+async def cache_stats():
+    return result_cache.stats()
+
 @basic_router.post("/extract")
-async def extract_cccd_info(file: UploadFile = File(...)):
+async def extract_cccd_info(
+    request: Request,
+    file: UploadFile = File(...),
+    min_confidence: Optional[float] = Query(None, ge=0.0, le=1.0),
+):
     """
     API endpoint để trích xuất thông tin từ ảnh CCCD
+    
+    min_confidence: trường có field_confidence thấp hơn ngưỡng được đánh dấu
+    needs_review; trường có confidence detect đã thấp hơn ngưỡng thì bỏ qua OCR.
+    field_score = confidence detect x confidence nhận dạng (heuristic);
+    field_confidence là field_score sau hiệu chỉnh FIELD_CONFIDENCE_CALIBRATION
+    (chưa cấu hình thì bằng field_score, chưa được hiệu chỉnh)
     """
     try:
         # Kiểm tra file type
@@ -33,10 +127,39 @@ async def extract_cccd_info(file: UploadFile = File(...)):
         
         # Đọc file
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
         
-        # Trích xuất thông tin
-        result = extractor.extract_info(image)
+        # Ảnh đã xử lý trước đó thì trả kết quả từ cache
+        extractor = await get_extractor()
+        cache_key = ResultCache.make_key(contents, extractor.fingerprint())
+        # Chỉ tầng cache trên đĩa mới cần chạy trong threadpool
+        result = result_cache.get_memory(cache_key)
+        if result is None and result_cache.persist_dir is not None:
+            result = await run_in_threadpool(result_cache.get_disk, cache_key)
+        
+        if result is None:
+            # Hàng đợi đầy thì trả 503 ngay, không tốn công decode ảnh;
+            # giữ chỗ trong hàng đợi cho tới khi ảnh được đưa vào scheduler
+            reservation = scheduler.reserve()
+            try:
+                # Decode ngoài event loop; ảnh JPEG lớn được decode ở độ phân giải thấp để detect
+                image = await run_in_threadpool(extractor.load_image, contents)
+                
+                # Trích xuất thông tin
+                result = await submit_unless_disconnected(request, image, min_confidence, reservation)
+            finally:
+                reservation.release()
+            if result is None:
+                return Response(status_code=CLIENT_CLOSED_REQUEST)
+            
+            # Không cache kết quả rỗng (có thể do lỗi) hoặc có trường bị bỏ qua OCR
+            if result and all(info['value'] is not None for info in result.values()):
+                if result_cache.persist_dir is None:
+                    result_cache.put(cache_key, result)
+                else:
+                    await run_in_threadpool(result_cache.put, cache_key, result)
+        
+        if min_confidence is not None:
+            result = OCRExtractor.mark_for_review(result, min_confidence)
         
         # Format response
         response = {
@@ -49,18 +172,28 @@ async def extract_cccd_info(file: UploadFile = File(...)):
         for field_name, info in result.items():
             response["data"][field_name] = info['value']
         
-        # # Thêm metadata
-        # response["metadata"] = {
-        #     field_name: {
-        #         "confidence": info['confidence'],
-        #         "bbox": info['bbox']
-        #     }
-        #     for field_name, info in result.items()
-        # }
+        # Thêm metadata: confidence detect (YOLO), nhận dạng (VietOCR), từng ký tự
+        response["metadata"] = {
+            field_name: {key: value for key, value in info.items() if key != 'value'}
+            for field_name, info in result.items()
+        }
+        
+        if min_confidence is not None:
+            response["needs_review"] = not result or any(info['needs_review'] for info in result.values())
         
         return JSONResponse(content=response)
 
     
+    except HTTPException:
+        raise
+    
+    except QueueFullError:
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please retry later",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
@@ -69,6 +202,14 @@ async def upload_image(file: UploadFile = File(...)):
     # Đọc file ảnh được upload
     contents = await file.read()
     
+    # Decode/encode chạy trong thread pool, không chặn event loop
+    img_byte_arr = await run_in_threadpool(reencode_jpeg, contents)
+    
+    # Trả về StreamingResponse
+    return StreamingResponse(img_byte_arr, media_type="image/jpeg")
+
+
+def reencode_jpeg(contents: bytes) -> io.BytesIO:
     # Mở ảnh bằng PIL
     image = Image.open(io.BytesIO(contents))
     
@@ -80,6 +221,4 @@ async def upload_image(file: UploadFile = File(...)):
     img_byte_arr = io.BytesIO()
     image.save(img_byte_arr, format='JPEG')
     img_byte_arr.seek(0)
-    
-    # Trả về StreamingResponse
-    return StreamingResponse(img_byte_arr, media_type="image/jpeg")
\ No newline at end of file
+    return img_byte_arr
@@ -0,0 +1,195 @@
+"""
+Pre-fork server: load the models once, then fork uvicorn workers
+
+    python -m app.serve --workers 4 --port 8000
+
+The parent process loads the shared OCRExtractor before forking, so all
+workers map the same YOLO and VietOCR parameter pages (copy-on-write,
+and page-cache backed when the weights are memory-mapped) instead of
+each loading its own copy. Every worker gets an equal share of the CPU
+cores for torch's intra-op thread pool. CUDA cannot be used across fork,
+so on GPU hosts this runs a single worker.
+
+With the ONNX backend the parent only exports the ONNX models: ONNX
+Runtime thread pools do not survive fork, so every worker creates its own
+sessions, sized to its share of the cores.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Callable
+
+import torch
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the OCR API with pre-forked workers")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch threads per worker, default: cores / workers")
+    return parser.parse_args()
+
+
+def load_shared_models():
+    """Load the models in the parent so that forked workers inherit them"""
+    from app.Ocr_extractor.model_registry import model_registry
+    from app.Ocr_extractor.ocr_extractor import OCRExtractor
+    from app.routers.development.basic_router import EXTRACTOR_CONFIG
+
+    # Keep the parent single-threaded: OpenMP thread pools do not survive fork
+    torch.set_num_threads(1)
+
+    start = time.perf_counter()
+    if EXTRACTOR_CONFIG.get('backend') == 'onnx':
+        OCRExtractor.export_onnx(EXTRACTOR_CONFIG['yolo_model_path'])
+        logger.info(f"Prepared ONNX models in {time.perf_counter() - start:.2f}s")
+        return
+
+    extractor = model_registry.get(EXTRACTOR_CONFIG)
+    extractor.ocr_predictor.model.eval()
+    logger.info(f"Loaded shared models in {time.perf_counter() - start:.2f}s")
+
+    # Objects allocated so far are never collected, so the GC does not
+    # touch (and copy) their pages in the workers
+    gc.collect()
+    gc.freeze()
+
+
+def run_worker(config: uvicorn.Config, sock, threads: int) -> None:
+    torch.set_num_threads(threads)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def spawn_worker(config: uvicorn.Config, sock, threads: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            run_worker(config, sock, threads)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def supervise(
+    spawn: Callable[[], int],
+    workers: int,
+    max_restarts: int = 5,
+    backoff: float = 1.0,
+    max_backoff: float = 60.0,
+    healthy_after: float = 60.0
+) -> int:
+    """
+    Run workers until SIGINT/SIGTERM, restarting the ones that exit
+
+    Restarts are delayed by backoff seconds, doubled for every further
+    failure up to max_backoff, so a worker that crashes at start up does not
+    fork in a loop. After max_restarts failures in a row the remaining
+    workers are stopped. A worker that ran for healthy_after seconds resets
+    the count.
+
+    Args:
+        spawn: Starts a worker process and returns its pid
+        workers: Number of workers to keep running
+
+    Returns:
+        Exit status: 0 after a signal, 1 if workers kept failing
+    """
+    started = {}
+    for _ in range(workers):
+        started[spawn()] = time.monotonic()
+
+    stopping = False
+    failures = 0
+
+    def stop_children():
+        for pid in started:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        stop_children()
+
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        while started:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            start = started.pop(pid, None)
+            if stopping or start is None:
+                continue
+
+            failures = 1 if time.monotonic() - start >= healthy_after else failures + 1
+            if failures > max_restarts:
+                logger.error(f"Worker {pid} exited with status {status}, {max_restarts} restarts failed, stopping")
+                stopping = True
+                stop_children()
+                continue
+
+            delay = min(max_backoff, backoff * 2 ** (failures - 1))
+            logger.warning(f"Worker {pid} exited with status {status}, restarting in {delay:.1f}s")
+            deadline = time.monotonic() + delay
+            while not stopping and time.monotonic() < deadline:
+                time.sleep(min(0.1, deadline - time.monotonic()))
+            if not stopping:
+                started[spawn()] = time.monotonic()
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+    return 1 if failures > max_restarts else 0
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from app.app import app
+
+    config = uvicorn.Config(app, host=args.host, port=args.port)
+
+    workers = max(1, args.workers)
+    if torch.cuda.is_available() and workers > 1:
+        logger.warning("CUDA cannot be shared across fork, running a single worker")
+        workers = 1
+
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+
+    if workers == 1:
+        torch.set_num_threads(threads)
+        uvicorn.Server(config).run()
+        return
+
+    load_shared_models()
+    sock = config.bind_socket()
+
+    logger.info(f"Starting {workers} workers with {threads} torch threads each")
+    status = supervise(lambda: spawn_worker(config, sock, threads), workers)
+
+    sock.close()
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
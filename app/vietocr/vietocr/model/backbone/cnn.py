@@ -18,6 +18,18 @@ class CNN(nn.Module):
     def forward(self, x):
         return self.model(x)
 
+    def key_padding_mask(self, widths, height, width):
+        """(N, W) mask of padded output positions, None if the backbone has none"""
+        if not hasattr(self.model, 'key_padding_mask'):
+            return None
+        return self.model.key_padding_mask(widths, height, width)
+
+    def fuse_for_inference(self):
+        """Simplify the backbone for inference if it supports it, see Vgg.fuse_for_inference"""
+        if hasattr(self.model, 'fuse_for_inference'):
+            self.model.fuse_for_inference()
+        return self
+
     def freeze(self):
         for name, param in self.model.features.named_parameters():
             if name != 'last_conv_1x1':
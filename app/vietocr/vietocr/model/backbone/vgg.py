@@ -3,6 +3,8 @@ from torch import nn
 from torchvision import models
 from einops import rearrange
 from torchvision.models._utils import IntermediateLayerGetter
+from torch.nn.modules.utils import _pair
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class Vgg(nn.Module):
@@ -42,6 +44,92 @@ class Vgg(nn.Module):
         conv = conv.permute(-1, 0, 1)
         return conv
 
+    def pool_geometry(self):
+        """(kernel, stride, padding) pairs of every pooling layer, in order"""
+        return [
+            (_pair(layer.kernel_size), _pair(layer.stride), _pair(layer.padding))
+            for layer in self.features
+            if isinstance(layer, (nn.AvgPool2d, nn.MaxPool2d))
+        ]
+
+    def output_size(self, height, width):
+        """
+        Feature map size for an input of the given size. Also works
+        elementwise on tensors of sizes.
+        """
+        return pooled_size(self.pool_geometry(), height, width)
+
+    def key_padding_mask(self, widths, height, width):
+        """
+        Mask of output positions that only cover right padding
+
+        Shape:
+            - widths: (N,) unpadded widths of the images in a (N, C, height, width) batch
+            - output: (N, W), True at padded positions
+        """
+        return pooled_padding_mask(self.pool_geometry(), widths, height, width)
+
+    def conv_blocks(self):
+        """Indices of the [conv, bn, relu] (or [conv, relu] once BN is folded) blocks of features"""
+        layers = list(self.features) + [None, None]
+        blocks = []
+        for i, layer in enumerate(layers[:-2]):
+            if not isinstance(layer, nn.Conv2d):
+                continue
+            if isinstance(layers[i + 1], nn.BatchNorm2d) and isinstance(layers[i + 2], nn.ReLU):
+                blocks.append([i, i + 1, i + 2])
+            elif isinstance(layers[i + 1], nn.ReLU):
+                blocks.append([i, i + 1])
+        return blocks
+
+    def fuse_for_inference(self):
+        """
+        Simplify an eval-mode backbone for inference, in place
+
+        Every BatchNorm is folded into the conv before it, ReLUs run in
+        place, pooling layers that are identities (kernel and stride 1) and
+        the dropout are removed. last_conv_1x1 follows a ReLU, so it cannot
+        be merged into the last conv.
+        """
+        if self.training:
+            raise RuntimeError("fuse_for_inference needs a backbone in eval mode")
+
+        layers = []
+        for layer in self.features:
+            if isinstance(layer, nn.BatchNorm2d) and layers and isinstance(layers[-1], nn.Conv2d):
+                layers[-1] = fuse_conv_bn_eval(layers[-1], layer)
+            elif isinstance(layer, (nn.AvgPool2d, nn.MaxPool2d)) and _is_identity_pool(layer):
+                continue
+            else:
+                if isinstance(layer, nn.ReLU):
+                    layer.inplace = True
+                layers.append(layer)
+
+        self.features = nn.Sequential(*layers)
+        self.dropout = nn.Identity()
+        return self
+
+def _is_identity_pool(layer):
+    geometry = (_pair(layer.kernel_size), _pair(layer.stride), _pair(layer.padding))
+    if geometry != ((1, 1), (1, 1), (0, 0)):
+        return False
+    return _pair(getattr(layer, 'dilation', 1)) == (1, 1)
+
+def pooled_size(pools, height, width):
+    for (kh, kw), (sh, sw), (ph, pw) in pools:
+        height = (height + 2*ph - kh) // sh + 1
+        width = (width + 2*pw - kw) // sw + 1
+    return height, width
+
+def pooled_padding_mask(pools, widths, height, width):
+    out_h, out_w = pooled_size(pools, height, width)
+    _, valid = pooled_size(pools, height, widths)
+    valid = valid.clamp(min=1)
+
+    # positions are ordered column by column, see Vgg.forward()
+    column = torch.arange(out_w, device=widths.device).repeat_interleave(out_h)
+    return column.unsqueeze(0) >= valid.unsqueeze(1)
+
 def vgg11_bn(ss, ks, hidden, pretrained=True, dropout=0.5):
     return Vgg('vgg11_bn', ss, ks, hidden, pretrained, dropout)
 
@@ -3,6 +3,7 @@ from torchvision import models
 import math
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 class LanguageTransformer(nn.Module):
     def __init__(self, vocab_size, 
@@ -53,21 +54,111 @@ class LanguageTransformer(nn.Module):
 
         return mask
     
-    def forward_encoder(self, src):
+    def forward_encoder(self, src, src_key_padding_mask=None):
         src = self.pos_enc(src*math.sqrt(self.d_model))
-        memory = self.transformer.encoder(src)
+        memory = self.transformer.encoder(src, src_key_padding_mask=src_key_padding_mask)
         return memory
     
-    def forward_decoder(self, tgt, memory):
+    def forward_decoder(self, tgt, memory, memory_key_padding_mask=None):
         tgt_mask = self.gen_nopeek_mask(tgt.shape[0]).to(tgt.device)
         tgt = self.pos_enc(self.embed_tgt(tgt) * math.sqrt(self.d_model))
         
-        output = self.transformer.decoder(tgt, memory, tgt_mask=tgt_mask)
+        output = self.transformer.decoder(tgt, memory, tgt_mask=tgt_mask,
+                                          memory_key_padding_mask=memory_key_padding_mask)
 #        output = rearrange(output, 't n e -> n t e')
         output = output.transpose(0, 1)
 
         return self.fc(output), memory
     
+    def init_decoder_state(self, memory, memory_key_padding_mask=None):
+        """
+        Precompute the cross-attention keys/values of every decoder layer so
+        that forward_decoder_step only has to process the newest token.
+
+        Shape:
+            - memory: (S, N, E)
+            - memory_key_padding_mask: (N, S), True at padded positions
+        """
+        layers = self.transformer.decoder.layers
+        memory_kv = []
+        for layer in layers:
+            attn = layer.multihead_attn
+            _, w_k, w_v = attn.in_proj_weight.chunk(3)
+            _, b_k, b_v = attn.in_proj_bias.chunk(3)
+            k = self._split_heads(F.linear(memory, w_k, b_k), attn.num_heads)
+            v = self._split_heads(F.linear(memory, w_v, b_v), attn.num_heads)
+            memory_kv.append((k, v))
+
+        memory_mask = None
+        if memory_key_padding_mask is not None:
+            # scaled_dot_product_attention attends where a boolean mask is True
+            memory_mask = ~memory_key_padding_mask[:, None, None, :]
+
+        return DecoderState(memory_kv, [None]*len(layers), memory_mask=memory_mask)
+
+    def forward_decoder_step(self, tgt, state):
+        """
+        Incremental counterpart of forward_decoder: decodes only the last
+        token of tgt, reading previous self-attention keys/values from state.
+
+        Shape:
+            - tgt: (T, N), only tgt[-1] is used
+            - output: (N, 1, V)
+        """
+        step = state.step
+        x = self.embed_tgt(tgt[-1:]) * math.sqrt(self.d_model)
+        x = self.pos_enc.dropout(x + self.pos_enc.pe[step:step+1])
+
+        for i, layer in enumerate(self.transformer.decoder.layers):
+            attn = layer.self_attn
+            q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+            q = self._split_heads(q, attn.num_heads)
+            k = self._split_heads(k, attn.num_heads)
+            v = self._split_heads(v, attn.num_heads)
+
+            if state.self_kv[i] is not None:
+                prev_k, prev_v = state.self_kv[i]
+                k = torch.cat([prev_k, k], dim=2)
+                v = torch.cat([prev_v, v], dim=2)
+            state.self_kv[i] = (k, v)
+
+            sa = self._attend(q, k, v, attn)
+            x = layer.norm1(x + layer.dropout1(sa))
+
+            attn = layer.multihead_attn
+            w_q, _, _ = attn.in_proj_weight.chunk(3)
+            b_q, _, _ = attn.in_proj_bias.chunk(3)
+            q = self._split_heads(F.linear(x, w_q, b_q), attn.num_heads)
+            mem_k, mem_v = state.memory_kv[i]
+
+            ca = self._attend(q, mem_k, mem_v, attn, state.memory_mask)
+            x = layer.norm2(x + layer.dropout2(ca))
+
+            ff = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+            x = layer.norm3(x + layer.dropout3(ff))
+
+        if self.transformer.decoder.norm is not None:
+            x = self.transformer.decoder.norm(x)
+
+        state.step += 1
+        output = x.transpose(0, 1)
+
+        return self.fc(output), state
+
+    @staticmethod
+    def _split_heads(x, num_heads):
+        # (T, N, E) -> (N, H, T, E/H)
+        t, n, e = x.shape
+        return x.reshape(t, n, num_heads, e // num_heads).permute(1, 2, 0, 3)
+
+    @staticmethod
+    def _attend(q, k, v, attn, attn_mask=None):
+        # (N, H, 1, E/H) -> (1, N, E)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        n, h, t, d = out.shape
+        out = out.permute(2, 0, 1, 3).reshape(t, n, h*d)
+        return attn.out_proj(out)
+
     def expand_memory(self, memory, beam_size):
         memory = memory.repeat(1, beam_size, 1)
         return memory
@@ -76,6 +167,24 @@ class LanguageTransformer(nn.Module):
         memory = memory[:, [i], :]
         return memory
 
+class DecoderState:
+    """Per-layer attention cache used by LanguageTransformer.forward_decoder_step"""
+
+    def __init__(self, memory_kv, self_kv, step=0, memory_mask=None):
+        self.memory_kv = memory_kv
+        self.self_kv = self_kv
+        self.step = step
+        self.memory_mask = memory_mask
+
+    def index_select(self, index):
+        """Keep, reorder or repeat batch rows, e.g. to drop finished sequences"""
+        self.memory_kv = [(k.index_select(0, index), v.index_select(0, index)) for k, v in self.memory_kv]
+        self.self_kv = [kv if kv is None else (kv[0].index_select(0, index), kv[1].index_select(0, index))
+                        for kv in self.self_kv]
+        if self.memory_mask is not None:
+            self.memory_mask = self.memory_mask.index_select(0, index)
+        return self
+
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model, dropout=0.1, max_len=100):
         super(PositionalEncoding, self).__init__()
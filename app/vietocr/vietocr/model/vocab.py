@@ -25,6 +25,12 @@ class Vocab():
         sent = ''.join([self.i2c[i] for i in ids[first:last]])
         return sent
     
+    def decode_probs(self, ids, probs):
+        """Per-character probabilities aligned with decode(ids)"""
+        first = 1 if self.go in ids else 0
+        last = ids.index(self.eos) if self.eos in ids else None
+        return [p for i, p in zip(ids[first:last], probs[first:last]) for _ in self.i2c[i]]
+
     def __len__(self):
         return len(self.c2i) + 4
     
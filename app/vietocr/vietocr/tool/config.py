@@ -1,5 +1,8 @@
+import copy
+import hashlib
+import os
 import yaml
-from app.vietocr.vietocr.tool.utils import download_config
+from app.vietocr.vietocr.tool.utils import download_config, get_cache_dir
 
 url_config = {
         'vgg_transformer':'vgg-transformer.yml',
@@ -11,6 +14,71 @@ url_config = {
         'base':'base.yml',
         }
 
+# yml files shipped with the repo, see app/vietocr/config
+bundled_config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'config')
+
+# parsed configs by file name, shared by the whole process
+_parsed_configs = {}
+
+def _candidate_names(fname):
+    # bundled files use '-' where some remote names use '_'
+    return [fname, fname.replace('_', '-')]
+
+def _read_bundled_config(fname):
+    for name in _candidate_names(fname):
+        path = os.path.join(bundled_config_dir, name)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+    return None
+
+def _read_cached_config(fname):
+    path = os.path.join(get_cache_dir('config'), fname)
+    if not os.path.exists(path) or not os.path.exists(path + '.sha256'):
+        return None
+
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    with open(path + '.sha256') as f:
+        checksum = f.read().strip()
+
+    if hashlib.sha256(text.encode('utf-8')).hexdigest() != checksum:
+        print('Config cache {} is corrupted. Ignore it!'.format(path))
+        return None
+    return text
+
+def _write_cached_config(fname, text):
+    path = os.path.join(get_cache_dir('config'), fname)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+    with open(tmp_path, 'w') as f:
+        f.write(hashlib.sha256(text.encode('utf-8')).hexdigest())
+    os.replace(tmp_path, path + '.sha256')
+
+def load_named_config(fname, allow_download=False):
+    """
+    Resolve a config file by name: bundled files first, then the on-disk
+    cache, and the network only if allow_download is set. Parsed configs
+    are kept in process, callers get a deep copy they are free to modify.
+    """
+    if fname not in _parsed_configs:
+        text = _read_bundled_config(fname)
+        if text is None:
+            text = _read_cached_config(fname)
+        if text is None:
+            if not allow_download:
+                raise FileNotFoundError('Config {} is neither bundled nor cached, '
+                                        'pass allow_download=True to fetch it'.format(fname))
+            text = download_config(fname, parse=False)
+            _write_cached_config(fname, text)
+
+        _parsed_configs[fname] = yaml.safe_load(text)
+
+    return copy.deepcopy(_parsed_configs[fname])
+
 class Cfg(dict):
     def __init__(self, config_dict):
         super(Cfg, self).__init__(**config_dict)
@@ -27,9 +95,9 @@ class Cfg(dict):
         return Cfg(base_config)
 
     @staticmethod
-    def load_config_from_name(name):
-        base_config = download_config(url_config['base'])
-        config = download_config(url_config[name])
+    def load_config_from_name(name, allow_download=False):
+        base_config = load_named_config(url_config['base'], allow_download)
+        config = load_named_config(url_config[name], allow_download)
 
         base_config.update(config)
         return Cfg(base_config)
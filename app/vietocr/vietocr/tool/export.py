@@ -0,0 +1,348 @@
+import json
+import math
+import os
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from app.vietocr.vietocr.model.backbone.vgg import pooled_padding_mask
+from app.vietocr.vietocr.model.seqmodel.transformer import DecoderState
+
+META_FILE = 'vietocr.json'
+
+# Files of an ONNX export directory
+ONNX_ENCODER = 'encoder.onnx'
+ONNX_DECODER = 'decoder.onnx'
+ENCODE_INPUTS = ['img', 'padding_mask']
+DECODE_INPUTS = ['tgt', 'step', 'memory_k', 'memory_v', 'memory_mask', 'self_k', 'self_v']
+
+
+class RecognizerExport(nn.Module):
+    """
+    Inference graph of a VGG + transformer VietOCR model with two entry
+    points, traced and frozen by export_model:
+
+    - encode(img, padding_mask): CNN + encoder, returning the cross-attention
+      keys/values of every decoder layer
+    - decode_step(tgt, step, ...): one decoder step against those and the
+      self-attention cache, like LanguageTransformer.forward_decoder_step
+
+    Per-layer caches are stacked on dim 1, (N, L, H, S, E/H), so a whole
+    cache is a single tensor.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.cnn = model.cnn
+        self.transformer = model.transformer
+
+    def encode(self, img, padding_mask):
+        src = self.cnn(img)
+        memory = self.transformer.forward_encoder(src, src_key_padding_mask=padding_mask)
+
+        state = self.transformer.init_decoder_state(memory)
+        memory_k = torch.stack([k for k, _ in state.memory_kv], dim=1)
+        memory_v = torch.stack([v for _, v in state.memory_kv], dim=1)
+        return memory_k, memory_v
+
+    def decode_step(self, tgt, step, memory_k, memory_v, memory_mask, self_k, self_v):
+        transformer = self.transformer
+        x = transformer.embed_tgt(tgt) * math.sqrt(transformer.d_model)
+        x = x + transformer.pos_enc.pe.index_select(0, step)
+
+        new_k, new_v = [], []
+        for i, layer in enumerate(transformer.transformer.decoder.layers):
+            attn = layer.self_attn
+            q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+            q = transformer._split_heads(q, attn.num_heads)
+            k = torch.cat([self_k[:, i], transformer._split_heads(k, attn.num_heads)], dim=2)
+            v = torch.cat([self_v[:, i], transformer._split_heads(v, attn.num_heads)], dim=2)
+            new_k.append(k)
+            new_v.append(v)
+
+            x = layer.norm1(x + transformer._attend(q, k, v, attn))
+
+            attn = layer.multihead_attn
+            w_q, _, _ = attn.in_proj_weight.chunk(3)
+            b_q, _, _ = attn.in_proj_bias.chunk(3)
+            q = transformer._split_heads(F.linear(x, w_q, b_q), attn.num_heads)
+            x = layer.norm2(x + transformer._attend(q, memory_k[:, i], memory_v[:, i], attn, memory_mask))
+
+            x = layer.norm3(x + layer.linear2(layer.activation(layer.linear1(x))))
+
+        if transformer.transformer.decoder.norm is not None:
+            x = transformer.transformer.decoder.norm(x)
+
+        return transformer.fc(x.transpose(0, 1)), torch.stack(new_k, dim=1), torch.stack(new_v, dim=1)
+
+
+def export_model(model, path, image_height=32, example_width=128):
+    """
+    Trace a VGG + transformer VietOCR model into a frozen TorchScript file
+
+    Freezing inlines the weights, folds BatchNorm into the preceding
+    convolutions and drops the (inactive) dropout layers. The pooling
+    geometry needed to build padding masks is stored next to the graph.
+
+    Args:
+        model: VietOCR model with a Vgg backbone and transformer seq model
+        path: Output file
+        image_height: Height of the input images
+        example_width: Width of the example batch used for tracing
+    """
+    model = model.eval()
+    module = RecognizerExport(model).eval()
+    device = next(model.parameters()).device
+
+    img = torch.rand(2, 3, image_height, example_width, device=device)
+    widths = torch.tensor([example_width, example_width // 2], device=device)
+    pools = model.cnn.model.pool_geometry()
+    padding_mask = pooled_padding_mask(pools, widths, image_height, example_width)
+
+    with torch.no_grad():
+        memory_k, memory_v = module.encode(img, padding_mask)
+        n, layers, heads, _, head_dim = memory_k.shape
+        self_kv = torch.zeros(n, layers, heads, 1, head_dim, device=device)
+        memory_mask = ~padding_mask[:, None, None, :]
+        tgt = torch.ones(1, n, dtype=torch.long, device=device)
+        step = torch.tensor([1], device=device)
+
+        traced = torch.jit.trace_module(module, {
+            'encode': (img, padding_mask),
+            'decode_step': (tgt, step, memory_k, memory_v, memory_mask, self_kv, self_kv),
+        })
+        frozen = torch.jit.freeze(traced.eval(), preserved_attrs=['encode', 'decode_step'])
+
+    meta = {'pools': pools, 'num_layers': layers, 'num_heads': heads, 'head_dim': head_dim}
+    torch.jit.save(frozen, path, _extra_files={META_FILE: json.dumps(meta)})
+
+
+class _EncodeGraph(nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, img, padding_mask):
+        return self.module.encode(img, padding_mask)
+
+
+class _DecodeStepGraph(nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, tgt, step, memory_k, memory_v, memory_mask, self_k, self_v):
+        return self.module.decode_step(tgt, step, memory_k, memory_v, memory_mask, self_k, self_v)
+
+
+def export_onnx(model, directory, image_height=32, example_width=128, source=None):
+    """
+    Export a VGG + transformer VietOCR model as two ONNX graphs
+
+    encoder.onnx and decoder.onnx hold RecognizerExport.encode and
+    decode_step with dynamic batch size, image width and cache length;
+    vietocr.json holds the pooling geometry and cache layout. Needs the
+    onnx and onnxscript packages and torch >= 2.5 for the dynamo exporter,
+    the TorchScript one bakes the attention shapes into the graph.
+
+    Args:
+        model: VietOCR model with a Vgg backbone and transformer seq model
+        directory: Output directory, created if missing
+        image_height: Height of the input images
+        example_width: Width of the example batch used for export
+        source: Identifier of the exported weights, stored in vietocr.json
+    """
+    from torch.export import Dim
+
+    model = model.eval()
+    module = RecognizerExport(model).eval()
+    device = next(model.parameters()).device
+    os.makedirs(directory, exist_ok=True)
+
+    img = torch.rand(2, 3, image_height, example_width, device=device)
+    widths = torch.tensor([example_width, example_width // 2], device=device)
+    pools = model.cnn.model.pool_geometry()
+    padding_mask = pooled_padding_mask(pools, widths, image_height, example_width)
+
+    batch, width, src_len, tgt_len = Dim('batch'), Dim('width'), Dim('src_len'), Dim('tgt_len')
+    with torch.no_grad():
+        memory_k, memory_v = module.encode(img, padding_mask)
+        n, layers, heads, _, head_dim = memory_k.shape
+        # a dynamic dimension must not be 0 or 1 in the example inputs, and
+        # the keys and values must be distinct tensors or they become one input
+        self_k = torch.zeros(n, layers, heads, 2, head_dim, device=device)
+        self_v = torch.zeros_like(self_k)
+        memory_mask = ~padding_mask[:, None, None, :]
+        tgt = torch.ones(1, n, dtype=torch.long, device=device)
+        step = torch.tensor([2], device=device)
+
+        torch.onnx.export(
+            _EncodeGraph(module).eval(), (img, padding_mask), os.path.join(directory, ONNX_ENCODER),
+            dynamo=True, input_names=ENCODE_INPUTS, output_names=['memory_k', 'memory_v'],
+            dynamic_shapes={'img': {0: batch, 3: width}, 'padding_mask': {0: batch, 1: src_len}},
+        )
+        torch.onnx.export(
+            _DecodeStepGraph(module).eval(), (tgt, step, memory_k, memory_v, memory_mask, self_k, self_v),
+            os.path.join(directory, ONNX_DECODER),
+            dynamo=True, input_names=DECODE_INPUTS, output_names=['logits', 'self_k_out', 'self_v_out'],
+            dynamic_shapes={
+                'tgt': {1: batch}, 'step': None,
+                'memory_k': {0: batch, 3: src_len}, 'memory_v': {0: batch, 3: src_len},
+                'memory_mask': {0: batch, 3: src_len},
+                'self_k': {0: batch, 3: tgt_len}, 'self_v': {0: batch, 3: tgt_len},
+            },
+        )
+
+    meta = {'pools': pools, 'num_layers': layers, 'num_heads': heads, 'head_dim': head_dim, 'source': source}
+    with open(os.path.join(directory, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def onnx_session_options(intra_op_threads=0, inter_op_threads=0):
+    """
+    ONNX Runtime session options for CPU inference
+
+    Args:
+        intra_op_threads: Threads per operator, 0 for torch.get_num_threads()
+            so the sessions follow the per-worker thread budget
+        inter_op_threads: Threads running independent operators in
+            parallel, 0 or 1 for sequential execution
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads or torch.get_num_threads()
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.inter_op_num_threads = inter_op_threads
+    else:
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+
+def read_onnx_meta(directory):
+    """Contents of vietocr.json of an ONNX export directory"""
+    with open(os.path.join(directory, META_FILE)) as f:
+        return json.load(f)
+
+
+def load_onnx(directory, intra_op_threads=0, inter_op_threads=0):
+    """Load a directory written by export_onnx as a CPU model usable by translate()"""
+    import onnxruntime as ort
+
+    options = onnx_session_options(intra_op_threads, inter_op_threads)
+    providers = ['CPUExecutionProvider']
+    encoder = ort.InferenceSession(os.path.join(directory, ONNX_ENCODER), options, providers=providers)
+    decoder = ort.InferenceSession(os.path.join(directory, ONNX_DECODER), options, providers=providers)
+    return ExportedVietOCR(_OnnxRecognizer(encoder, decoder), read_onnx_meta(directory))
+
+
+class _OnnxRecognizer:
+    """encode and decode_step of RecognizerExport on ONNX Runtime sessions"""
+
+    def __init__(self, encoder, decoder):
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def encode(self, img, padding_mask):
+        outputs = self.encoder.run(None, _feed(ENCODE_INPUTS, (img, padding_mask)))
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+    def decode_step(self, *inputs):
+        outputs = self.decoder.run(None, _feed(DECODE_INPUTS, inputs))
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+
+def _feed(names, tensors):
+    return {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in zip(names, tensors)}
+
+
+def load_exported(path, device='cpu'):
+    """Load a file written by export_model as a model usable by translate()"""
+    extra_files = {META_FILE: ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    meta = json.loads(extra_files[META_FILE])
+    return ExportedVietOCR(module, meta)
+
+
+class ExportedVietOCR:
+    """
+    Runs an exported recognizer behind the interface translate() and
+    beam_search() use: encode() and a transformer with init_decoder_state
+    and forward_decoder_step
+    """
+
+    seq_modeling = 'transformer'
+
+    def __init__(self, module, meta):
+        self.module = module
+        self.pools = [tuple(tuple(pair) for pair in pool) for pool in meta['pools']]
+        self.transformer = _ExportedDecoder(module, meta)
+
+    def eval(self):
+        return self
+
+    def encode(self, img, widths=None):
+        """Returns the encoded memory (cross-attention keys/values) and padding mask"""
+        if widths is None:
+            widths = torch.full((img.size(0),), img.shape[3], device=img.device)
+        padding_mask = pooled_padding_mask(self.pools, widths, img.shape[2], img.shape[3])
+        memory = self.module.encode(img, padding_mask)
+        return memory, padding_mask
+
+
+class _ExportedDecoder:
+    def __init__(self, module, meta):
+        self.module = module
+        self.num_layers = meta['num_layers']
+        self.num_heads = meta['num_heads']
+        self.head_dim = meta['head_dim']
+
+    def init_decoder_state(self, memory, memory_key_padding_mask):
+        memory_k, memory_v = memory
+        n = memory_k.size(0)
+        empty = memory_k.new_zeros(n, self.num_layers, self.num_heads, 0, self.head_dim)
+        return DecoderState([(memory_k, memory_v)], [(empty, empty)],
+                            memory_mask=~memory_key_padding_mask[:, None, None, :])
+
+    def forward_decoder_step(self, tgt, state):
+        memory_k, memory_v = state.memory_kv[0]
+        self_k, self_v = state.self_kv[0]
+        step = torch.tensor([state.step], device=tgt.device)
+
+        output, self_k, self_v = self.module.decode_step(
+            tgt[-1:], step, memory_k, memory_v, state.memory_mask, self_k, self_v)
+
+        state.self_kv[0] = (self_k, self_v)
+        state.step += 1
+        return output, state
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from app.vietocr.vietocr.tool.config import Cfg
+    from app.vietocr.vietocr.tool.predictor import Predictor
+
+    parser = argparse.ArgumentParser(description="Export a VietOCR recognizer to frozen TorchScript or ONNX")
+    parser.add_argument('output', help="output file, e.g. vgg_transformer.ts, or directory with --onnx")
+    parser.add_argument('--onnx', action='store_true', help="export ONNX graphs for ONNX Runtime")
+    parser.add_argument('--config', default='vgg_transformer')
+    parser.add_argument('--weights', default=None, help="weights file or url, default: from the config")
+    args = parser.parse_args()
+
+    config = Cfg.load_config_from_name(args.config)
+    config['cnn']['pretrained'] = False
+    config['device'] = 'cpu'
+    config['predictor']['exported'] = None
+    if args.weights:
+        config['weights'] = args.weights
+
+    model = Predictor(config).model
+    if args.onnx:
+        export_onnx(model, args.output, image_height=config['dataset']['image_height'], source=config['weights'])
+    else:
+        export_model(model, args.output, image_height=config['dataset']['image_height'])
+    print(f"Exported {args.config} to {args.output}")
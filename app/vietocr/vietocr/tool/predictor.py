@@ -1,6 +1,11 @@
-from app.vietocr.vietocr.tool.translate import build_model, translate, translate_beam_search, process_input, predict, batch_translate_beam_search
-from app.vietocr.vietocr.tool.utils import download_weights
-
+from app.vietocr.vietocr.tool.translate import build_model, translate, translate_beam_search, process_input, predict, batch_translate_beam_search, beam_search, resize_image, process_batch, score_tokens
+from app.vietocr.vietocr.tool.utils import download_weights, load_weights
+from app.vietocr.vietocr.tool.export import load_exported, load_onnx
+from app.vietocr.vietocr.tool.quantize import observe_backbone, quantize_model
+from app.vietocr.vietocr.model.vocab import Vocab
+
+import math
+import os
 import torch
 from collections import defaultdict
 
@@ -8,26 +13,93 @@ class Predictor():
     def __init__(self, config):
 
         device = config['device']
-        
-        model, vocab = build_model(config)
-        weights = '/tmp/weights.pth'
 
-        if config['weights'].startswith('http'):
-            weights = download_weights(config['weights'])
+        exported = config['predictor'].get('exported')
+        if exported and os.path.isdir(exported):
+            # ONNX graphs run on CPU whatever the configured device
+            device = 'cpu'
+            model = load_onnx(exported, config['predictor'].get('intra_op_threads', 0),
+                              config['predictor'].get('inter_op_threads', 0))
+            vocab = Vocab(config['vocab'])
+        elif exported and os.path.exists(exported):
+            # the frozen graph already holds the weights
+            model = load_exported(exported, device)
+            vocab = Vocab(config['vocab'])
         else:
-            weights = config['weights']
-
-        model.load_state_dict(torch.load(weights, map_location=torch.device(device)))
+            model, vocab = self._load_model(config)
 
         self.config = config
         self.model = model
         self.vocab = vocab
         self.device = device
 
+    @staticmethod
+    def _load_model(config):
+        device = config['device']
+
+        model, vocab = build_model(config)
+
+        if config['weights'].startswith('http'):
+            weights = download_weights(config['weights'], md5=config.get('weights_md5'))
+        else:
+            weights = config['weights']
+
+        model.eval()
+
+        def fold_batchnorm(state_dict):
+            model.load_state_dict(state_dict)
+            model.cnn.fuse_for_inference()
+            return model.state_dict()
+
+        # BatchNorm is folded into the convs once, when the weight store is
+        # written, so the stored tensors are the ones the model runs with.
+        # On CPU the model keeps the memory-mapped tensors instead of copying
+        # them, so every worker on the host shares the same page-cache pages
+        state_dict = load_weights(weights, device, transform=fold_batchnorm, tag='bn_folded')
+
+        # drop BatchNorm, dropout and identity pools from the structure (a
+        # no-op if fold_batchnorm already ran)
+        model.cnn.fuse_for_inference()
+        model.load_state_dict(state_dict, assign=torch.device(device).type == 'cpu')
+
+        return model, vocab
+
+    def quantize(self, calibration_images=None, observer_stats=None):
+        """
+        Switch the model to INT8 for CPU inference
+
+        The nn.Linear layers are quantized dynamically. With
+        calibration_images (RGB crops like the ones passed to predict_batch)
+        or observer_stats (see calibration_stats) the Vgg convolutions are
+        also quantized statically.
+        """
+        if not isinstance(self.model, torch.nn.Module) or torch.device(self.device).type != 'cpu':
+            raise ValueError("INT8 quantization needs the eager model on CPU")
+
+        batches = self._calibration_batches(calibration_images) if calibration_images else None
+        self.model = quantize_model(self.model.eval(), batches, observer_stats)
+
+    def calibration_stats(self, calibration_images):
+        """
+        Activation ranges of the Vgg convolutions on calibration_images
+
+        Computed once offline and passed to quantize() as observer_stats,
+        so workers need no calibration scans at start up.
+        """
+        return observe_backbone(self.model.eval().cnn.model, self._calibration_batches(calibration_images))
+
+    def _calibration_batches(self, calibration_images):
+        dataset = self.config['dataset']
+        return [
+            process_batch([resize_image(img, dataset['image_height'], dataset['image_min_width'],
+                                        dataset['image_max_width'])]).float().div_(255)
+            for img in calibration_images
+        ]
+
     def predict(self, img, return_prob=False):
         img = process_input(img, self.config['dataset']['image_height'], 
                 self.config['dataset']['image_min_width'], self.config['dataset']['image_max_width'])        
-        img = img.to(self.config['device'])
+        img = img.to(self.device)
 
         if self.config['predictor']['beamsearch']:
             sent = translate_beam_search(img, self.model)
@@ -38,6 +110,10 @@ class Predictor():
             s = s[0].tolist()
             prob = prob[0]
 
+            if self._needs_beam(prob):
+                sents, probs, _ = self._beam_search(img)
+                s, prob = sents[0].tolist(), probs[0]
+
         s = self.vocab.decode(s)
         
         if return_prob:
@@ -45,41 +121,93 @@ class Predictor():
         else:
             return s
 
-    def predict_batch(self, imgs, return_prob=False):
+    def predict_batch(self, imgs, return_prob=False, pad_width=False, width_class=128, return_char_probs=False):
+        """
+        Recognize a list of images. Images are grouped into classes of
+        width_class pixels of resized width and right-padded to the widest
+        image of their class; with pad_width=True they all share a single
+        batch. Padded positions are masked out of attention.
+
+        Each bucket is built as one uint8 tensor (pinned when running on
+        CUDA) and normalized on the device.
+
+        With return_char_probs=True, returns (sents, probs, char_probs) where
+        char_probs[i] holds one probability per character of sents[i], taken
+        from the same decoding pass.
+
+        If config['predictor']['beamsearch_threshold'] is set, images whose
+        greedy mean char probability is below it are decoded again, together,
+        with beam search.
+        """
         bucket = defaultdict(list)
         bucket_idx = defaultdict(list)
         bucket_pred = {}
         
-        sents, probs = [0]*len(imgs), [0]*len(imgs)
+        sents, probs, char_probs = [0]*len(imgs), [0]*len(imgs), [0]*len(imgs)
 
         for i, img in enumerate(imgs):
-            img = process_input(img, self.config['dataset']['image_height'], 
+            img = resize_image(img, self.config['dataset']['image_height'], 
                 self.config['dataset']['image_min_width'], self.config['dataset']['image_max_width'])        
         
-            bucket[img.shape[-1]].append(img)
-            bucket_idx[img.shape[-1]].append(i)
+            key = 0 if pad_width else math.ceil(img.shape[1] / width_class)
+            bucket[key].append(img)
+            bucket_idx[key].append(i)
 
+        pin_memory = torch.device(self.device).type == 'cuda'
 
         for k, batch in bucket.items():
-            batch = torch.cat(batch, 0).to(self.device)
-            s, prob = translate(batch, self.model)
-            prob = prob.tolist()
+            widths = torch.tensor([img.shape[1] for img in batch], device=self.device)
+            batch = process_batch(batch, pin_memory=pin_memory)
+            batch = batch.to(self.device, non_blocking=pin_memory).float().div_(255)
+            s, prob, token_probs = translate(batch, self.model, widths=widths, return_char_probs=True)
+            s, token_probs = s.tolist(), token_probs.tolist()
+
+            low = [i for i, p in enumerate(prob) if self._needs_beam(p)]
+            if low:
+                index = torch.tensor(low, device=self.device)
+                beam_s, beam_prob, beam_token_probs = self._beam_search(batch[index], widths[index])
+                for j, i in enumerate(low):
+                    s[i], prob[i], token_probs[i] = beam_s[j].tolist(), beam_prob[j], beam_token_probs[j].tolist()
 
-            s = s.tolist()
+            prob = prob.tolist()
+            char_prob = [self.vocab.decode_probs(ids, p) for ids, p in zip(s, token_probs)]
             s = self.vocab.batch_decode(s)
 
-            bucket_pred[k] = (s, prob)
+            bucket_pred[k] = (s, prob, char_prob)
 
 
         for k in bucket_pred:
             idx = bucket_idx[k]
-            sent, prob = bucket_pred[k]
+            sent, prob, char_prob = bucket_pred[k]
             for i, j in enumerate(idx):
                 sents[j] = sent[i]
                 probs[j] = prob[i]
+                char_probs[j] = char_prob[i]
    
-        if return_prob: 
+        if return_char_probs:
+            return sents, probs, char_probs
+        elif return_prob: 
             return sents, probs
         else: 
             return sents
 
+    def _needs_beam(self, prob):
+        """Whether a greedy result falls below the beam search threshold"""
+        threshold = self.config['predictor'].get('beamsearch_threshold')
+        # no characters decoded gives a nan probability, also worth a retry
+        return threshold is not None and not prob >= threshold
+
+    def _beam_search(self, img, widths=None):
+        """
+        Batched beam search with the decoder cache, or the per-image Beam
+        search for sequence models without one (seq2seq), whose tokens are
+        then scored to get their probabilities
+        """
+        if hasattr(self.model.transformer, 'init_decoder_state'):
+            return beam_search(img, self.model, beam_size=self._beam_size(), widths=widths)
+
+        sents = batch_translate_beam_search(img, self.model, beam_size=self._beam_size())
+        return score_tokens(img, self.model, sents)
+
+    def _beam_size(self):
+        return self.config['predictor'].get('beam_size', 4)
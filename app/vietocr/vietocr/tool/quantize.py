@@ -0,0 +1,153 @@
+import copy
+import io
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao import quantization
+
+from app.vietocr.vietocr.model.backbone.vgg import Vgg
+
+
+def quantize_linear(model):
+    """
+    Dynamic INT8 quantization of the nn.Linear layers (transformer
+    feed-forward layers and output projection), in place
+
+    Weights are stored as int8, activations are quantized per batch at run
+    time, so no calibration is needed. The attention projections are used
+    through their weight tensors by the KV-cache decoder and stay fp32.
+    """
+    return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def quantize_backbone(vgg, calibration_batches=None, observer_stats=None):
+    """
+    Static INT8 quantization of the Vgg convolutions, in place
+
+    Conv + BatchNorm + ReLU blocks are fused, activation ranges are observed
+    on calibration_batches (or taken from observer_stats, see
+    observe_backbone) and the features run on quantized tensors between a
+    quant and dequant stub. The 1x1 output conv stays fp32.
+
+    Args:
+        vgg: Vgg backbone in eval mode
+        calibration_batches: Iterable of (N, 3, H, W) float batches,
+            preprocessed like the inputs at inference
+        observer_stats: Activation observer state from observe_backbone,
+            used instead of calibration_batches
+    """
+    features = _prepare_backbone(vgg)
+    if observer_stats is not None:
+        features.load_state_dict(observer_stats, strict=False)
+    else:
+        _observe(features, calibration_batches)
+    quantization.convert(features, inplace=True)
+
+    vgg.features = features
+    return vgg
+
+
+def observe_backbone(vgg, calibration_batches):
+    """
+    Activation ranges of the Vgg convolutions observed on calibration_batches
+
+    Calibrate once offline and pass the result to quantize_backbone as
+    observer_stats, so processes do not need calibration data at start up.
+    vgg is left unchanged.
+
+    Returns:
+        State dict of the activation observers
+    """
+    features = _prepare_backbone(copy.deepcopy(vgg))
+    _observe(features, calibration_batches)
+    return {k: v for k, v in features.state_dict().items() if 'activation_post_process' in k}
+
+
+def _prepare_backbone(vgg):
+    if not isinstance(vgg, Vgg):
+        raise ValueError(f"Static quantization needs a Vgg backbone, got {type(vgg).__name__}")
+
+    # the stub shifts every layer index by one
+    blocks = [[str(i + 1) for i in block] for block in vgg.conv_blocks()]
+    features = nn.Sequential(quantization.QuantStub(), *vgg.features, quantization.DeQuantStub()).eval()
+    features.qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+
+    quantization.fuse_modules(features, blocks, inplace=True)
+    quantization.prepare(features, inplace=True)
+    return features
+
+
+def _observe(features, calibration_batches):
+    with torch.no_grad():
+        for batch in calibration_batches:
+            features(batch)
+
+
+def quantize_model(model, calibration_batches=None, observer_stats=None):
+    """
+    INT8 VietOCR model for CPU inference, in place
+
+    Args:
+        model: VietOCR model in eval mode
+        calibration_batches: Batches to calibrate the static quantization
+            of the Vgg convolutions; without them (or observer_stats) only
+            the Linear layers are quantized
+        observer_stats: Activation observer state from observe_backbone
+    """
+    if calibration_batches is not None or observer_stats is not None:
+        quantize_backbone(model.cnn.model, calibration_batches, observer_stats)
+    return quantize_linear(model)
+
+
+def model_bytes(model):
+    """Serialized size of the model's state dict"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def accuracy_report(reference, quantized, crops):
+    """
+    Compare an INT8 Predictor with its fp32 reference on the same crops
+
+    Returns:
+        Dictionary with the share of identical texts, the character error
+        rate of the INT8 texts against the fp32 texts, the mean absolute
+        change of the text confidence, seconds per crop and model size of
+        both predictors
+    """
+    start = time.perf_counter()
+    ref_texts, ref_probs = reference.predict_batch(crops, return_prob=True)
+    ref_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    texts, probs = quantized.predict_batch(crops, return_prob=True)
+    seconds = time.perf_counter() - start
+
+    errors = sum(_edit_distance(text, ref) for text, ref in zip(texts, ref_texts))
+    chars = sum(len(ref) for ref in ref_texts)
+    prob_delta = np.abs(np.asarray(probs, dtype=float) - np.asarray(ref_probs, dtype=float))
+
+    return {
+        'crops': len(crops),
+        'exact_match': float(np.mean([text == ref for text, ref in zip(texts, ref_texts)])) if crops else 1.0,
+        'cer': errors / max(chars, 1),
+        'mean_confidence_delta': float(np.nanmean(prob_delta)) if crops else 0.0,
+        'fp32_seconds_per_crop': ref_seconds / max(len(crops), 1),
+        'int8_seconds_per_crop': seconds / max(len(crops), 1),
+        'fp32_model_bytes': model_bytes(reference.model),
+        'int8_model_bytes': model_bytes(quantized.model),
+    }
+
+
+def _edit_distance(a, b):
+    """Levenshtein distance between two strings"""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
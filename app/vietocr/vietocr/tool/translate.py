@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import math
+import cv2
 from PIL import Image
 from torch.nn.functional import log_softmax, softmax
 
@@ -8,37 +9,193 @@ from app.vietocr.vietocr.model.transformerocr import VietOCR
 from app.vietocr.vietocr.model.vocab import Vocab
 from app.vietocr.vietocr.model.beam import Beam
 
-def batch_translate_beam_search(img, model, beam_size=4, candidates=1, max_seq_length=128, sos_token=1, eos_token=2):
-    # img: NxCxHxW
+def batch_translate_beam_search(img, model, beam_size=4, max_seq_length=128, sos_token=1, eos_token=2):
+    """
+    img: NxCxHxW
+    Returns the best hypothesis of every image: a token list starting with
+    SOS, without EOS. There is no candidates argument anymore: only the
+    best hypothesis was ever returned, and beam_search() keeps no others.
+    """
     model.eval()
     device = img.device
-    sents = []
 
+    if hasattr(model.transformer, 'init_decoder_state'):
+        sents, _, _ = beam_search(img, model, beam_size, max_seq_length, sos_token, eos_token)
+        return [_strip_eos(sent, eos_token) for sent in sents.tolist()]
+
+    sents = []
     with torch.no_grad():
         src = model.cnn(img)
-        print(src.shap)
         memories = model.transformer.forward_encoder(src)
-        for i in range(src.size(0)):
+        for i in range(img.size(0)):
 #            memory = memories[:,i,:].repeat(1, beam_size, 1) # TxNxE
             memory = model.transformer.get_memory(memories, i)
-            sent = beamsearch(memory, model, device, beam_size, candidates, max_seq_length, sos_token, eos_token)
+            sent = beamsearch(memory, model, device, beam_size, max_seq_length=max_seq_length,
+                              sos_token=sos_token, eos_token=eos_token)
             sents.append(sent)
 
-    sents = np.asarray(sents)
-
     return sents
    
-def translate_beam_search(img, model, beam_size=4, candidates=1, max_seq_length=128, sos_token=1, eos_token=2):
+def translate_beam_search(img, model, beam_size=4, max_seq_length=128, sos_token=1, eos_token=2):
     # img: 1xCxHxW
+    return batch_translate_beam_search(img, model, beam_size, max_seq_length, sos_token, eos_token)[0]
+
+def _strip_eos(sent, eos_token):
+    # same format as beamsearch(): SOS and the tokens before EOS
+    return sent[:sent.index(eos_token)] if eos_token in sent else sent
+
+def beam_search(img, model, beam_size=4, max_seq_length=128, sos_token=1, eos_token=2, pad_token=0,
+                widths=None, length_penalty=1.0):
+    """
+    Batched beam search over (batch x beam) rows on the model's device,
+    decoding one token per step against the decoder's key/value cache.
+
+    Beams that emit EOS keep their score and only extend with padding. An
+    image stops decoding once its highest scoring beam has finished, since
+    no unfinished beam can score higher anymore. The best finished beam is
+    then chosen by its log probability divided by length**length_penalty.
+
+    Returns the same arrays as translate(..., return_char_probs=True):
+    tokens (N, T), mean char probability (N,) and token probabilities (N, T).
+    """
     model.eval()
     device = img.device
+    k = beam_size
 
     with torch.no_grad():
-        src = model.cnn(img)
-        memory = model.transformer.forward_encoder(src) #TxNxE
-        sent = beamsearch(memory, model, device, beam_size, candidates, max_seq_length, sos_token, eos_token)
+        memory, padding_mask = _encode(img, model, widths)
+        state = model.transformer.init_decoder_state(memory, padding_mask)
+
+        # every image starts with k copies of its cache
+        batch_size = img.size(0)
+        state.index_select(torch.arange(batch_size, device=device).repeat_interleave(k))
+
+        total_length = max_seq_length + 2
+        tokens = torch.full((batch_size, k, total_length), pad_token, dtype=torch.long, device=device)
+        tokens[:, :, 0] = sos_token
+        token_log_probs = torch.zeros(batch_size, k, total_length, device=device)
+
+        # the beams are identical at first, so only the first one is expanded
+        scores = torch.full((batch_size, k), float('-inf'), device=device)
+        scores[:, 0] = 0
+        finished = torch.zeros(batch_size, k, dtype=torch.bool, device=device)
+
+        beam_offsets = torch.arange(k, device=device)
+        active = torch.arange(batch_size, device=device)
+
+        length = 1
+        while length < total_length:
+            n = len(active)
+            tgt_inp = tokens[active, :, length - 1].reshape(1, n*k)
+            output, state = model.transformer.forward_decoder_step(tgt_inp, state)
+            log_probs = log_softmax(output[:, -1], dim=-1).view(n, k, -1)
+            vocab_size = log_probs.size(-1)
+
+            # finished beams can only be extended with padding, at no cost
+            done = finished[active]
+            log_probs = log_probs.masked_fill(done.unsqueeze(-1), float('-inf'))
+            log_probs[:, :, pad_token] = log_probs[:, :, pad_token].masked_fill(done, 0)
+
+            candidates = (scores[active].unsqueeze(-1) + log_probs).view(n, -1)
+            top_scores, top_ids = candidates.topk(k, dim=-1)
+            origin = torch.div(top_ids, vocab_size, rounding_mode='floor')
+            next_tokens = top_ids % vocab_size
+
+            # reorder the beams of every active image by origin
+            gather_index = origin.unsqueeze(-1).expand(-1, -1, total_length)
+            beam_tokens = tokens[active].gather(1, gather_index)
+            beam_tokens[:, :, length] = next_tokens
+            beam_log_probs = token_log_probs[active].gather(1, gather_index)
+            beam_log_probs[:, :, length] = log_probs.view(n, -1).gather(1, top_ids)
+
+            tokens[active] = beam_tokens
+            token_log_probs[active] = beam_log_probs
+            scores[active] = top_scores
+            finished[active] = done.gather(1, origin) | (next_tokens == eos_token)
+
+            rows = (torch.arange(n, device=device).unsqueeze(1)*k + origin).view(-1)
+            state.index_select(rows)
+            length += 1
+
+            # drop images whose best beam has finished (topk keeps beams sorted)
+            image_done = finished[active, 0]
+            if image_done.any():
+                keep = (~image_done).nonzero().squeeze(1)
+                active = active[keep]
+                state.index_select((keep.unsqueeze(1)*k + beam_offsets).view(-1))
+
+            if len(active) == 0:
+                break
+
+        tokens = tokens[:, :, :length]
+        token_probs = token_log_probs[:, :, :length].exp().masked_fill(tokens == pad_token, 0)
+
+        # pick the best finished beam per image, normalized by its length
+        # (EOS included); unfinished beams only count when none finished
+        lengths = (tokens[:, :, 1:] != pad_token).sum(-1).clamp(min=1)
+        normalized = scores / lengths.float().pow(length_penalty)
+        eligible = finished | ~finished.any(dim=1, keepdim=True)
+        best = normalized.masked_fill(~eligible, float('-inf')).argmax(dim=1)
+        index = torch.arange(batch_size, device=device)
+        translated_sentence = tokens[index, best]
+        token_probs = token_probs[index, best]
+
+        mask = translated_sentence > 3
+        char_probs = (token_probs*mask).sum(-1)/mask.sum(-1)
+
+    return translated_sentence.cpu().numpy(), char_probs.cpu().numpy(), token_probs.cpu().numpy()
+
+def score_tokens(img, model, sents, sos_token=1, eos_token=2, pad_token=0):
+    """
+    Probabilities of given token sequences, decoding them with teacher
+    forcing. Used for sequence models without a decoder cache, whose beam
+    search (beamsearch()) only returns tokens.
+
+    sents: one token list per image, starting with SOS, without EOS.
+    Returns the same arrays as translate(..., return_char_probs=True).
+    """
+    model.eval()
+    device = img.device
 
-    return sent
+    length = max(len(sent) for sent in sents) + 1
+    tokens = torch.full((len(sents), length), pad_token, dtype=torch.long)
+    for i, sent in enumerate(sents):
+        tokens[i, :len(sent) + 1] = torch.tensor(sent + [eos_token])
+    tokens = tokens.to(device)
+
+    with torch.no_grad():
+        memory, _ = _encode(img, model)
+        token_probs = torch.zeros(len(sents), length, device=device)
+        token_probs[:, 0] = 1
+        for t in range(1, length):
+            output, memory = model.transformer.forward_decoder(tokens[:, :t].T, memory)
+            probs = softmax(output[:, -1], dim=-1)
+            token_probs[:, t] = probs.gather(1, tokens[:, t:t + 1]).squeeze(1)
+
+        token_probs = token_probs.masked_fill(tokens == pad_token, 0)
+        mask = tokens > 3
+        char_probs = (token_probs*mask).sum(-1)/mask.sum(-1)
+
+    return tokens.cpu().numpy(), char_probs.cpu().numpy(), token_probs.cpu().numpy()
+
+def _encode(img, model, widths=None):
+    """CNN + encoder, masking positions that only cover right padding"""
+    if hasattr(model, 'encode'):
+        # exported models run both in one graph
+        return model.encode(img, widths)
+
+    src = model.cnn(img)
+
+    padding_mask = None
+    if widths is not None and model.seq_modeling == 'transformer':
+        padding_mask = model.cnn.key_padding_mask(widths, img.shape[2], img.shape[3])
+
+    if padding_mask is not None:
+        memory = model.transformer.forward_encoder(src, src_key_padding_mask=padding_mask)
+    else:
+        memory = model.transformer.forward_encoder(src)
+
+    return memory, padding_mask
         
 def beamsearch(memory, model, device, beam_size=4, candidates=1, max_seq_length=128, sos_token=1, eos_token=2):    
     # memory: Tx1xE
@@ -55,7 +212,7 @@ def beamsearch(memory, model, device, beam_size=4, candidates=1, max_seq_length=
             tgt_inp = beam.get_current_state().transpose(0,1).to(device)  # TxN
             decoder_outputs, memory = model.transformer.forward_decoder(tgt_inp, memory)
 
-            log_prob = log_softmax(decoder_outputs[:,-1, :].squeeze(0), dim=-1)
+            log_prob = log_softmax(decoder_outputs[:,-1, :], dim=-1)
             beam.advance(log_prob.cpu())
             
             if beam.done():
@@ -70,50 +227,80 @@ def beamsearch(memory, model, device, beam_size=4, candidates=1, max_seq_length=
     
     return [1] + [int(i) for i in hypothesises[0][:-1]]
 
-def translate(img, model, max_seq_length=128, sos_token=1, eos_token=2):
-    "data: BxCXHxW"
+def translate(img, model, max_seq_length=128, sos_token=1, eos_token=2, pad_token=0, widths=None,
+              return_char_probs=False):
+    """
+    data: BxCXHxW
+    widths: unpadded width of each right-padded image (optional). Positions
+    that only cover padding are masked out of attention.
+    return_char_probs: also return the probability of every decoded token,
+    (B, T) aligned with the returned tokens
+    """
     model.eval()
     device = img.device
 
     with torch.no_grad():
-        src = model.cnn(img)
-        memory = model.transformer.forward_encoder(src)
-
-        translated_sentence = [[sos_token]*len(img)]
-        char_probs = [[1]*len(img)]
-
-        max_length = 0
-
-        while max_length <= max_seq_length and not all(np.any(np.asarray(translated_sentence).T==eos_token, axis=1)):
-
-            tgt_inp = torch.LongTensor(translated_sentence).to(device)
-            
+        memory, padding_mask = _encode(img, model, widths)
+
+        # decode one token at a time against a key/value cache when the
+        # sequence model supports it, instead of re-running the whole prefix
+        state = None
+        if hasattr(model.transformer, 'init_decoder_state'):
+            state = model.transformer.init_decoder_state(memory, padding_mask)
+
+        # tokens and probabilities live on the model's device for the whole
+        # loop and are copied to host once at the end
+        batch_size = img.size(0)
+        translated_sentence = torch.full((batch_size, max_seq_length + 2), pad_token, dtype=torch.long, device=device)
+        translated_sentence[:, 0] = sos_token
+        char_probs = torch.zeros(batch_size, max_seq_length + 2, device=device)
+        char_probs[:, 0] = 1
+
+        # rows that emitted EOS are dropped from the active set, so the cost
+        # of a step only depends on how many sequences are still decoding;
+        # rows left behind keep pad tokens and do not count towards the mean
+        # probability
+        active = torch.arange(batch_size, device=device)
+
+        length = 1
+        while length <= max_seq_length + 1:
 #            output = model(img, tgt_inp, tgt_key_padding_mask=None)
 #            output = model.transformer(src, tgt_inp, tgt_key_padding_mask=None)
-            output, memory = model.transformer.forward_decoder(tgt_inp, memory)
-            output = softmax(output, dim=-1)
-            output = output.to('cpu')
+            if state is not None:
+                tgt_inp = translated_sentence[active, length - 1].unsqueeze(0)
+                output, state = model.transformer.forward_decoder_step(tgt_inp, state)
+            else:
+                tgt_inp = translated_sentence[:, :length].T
+                output, memory = model.transformer.forward_decoder(tgt_inp, memory)
+                output = output[active]
+
+            values, indices = softmax(output[:, -1], dim=-1).max(dim=-1)
+
+            translated_sentence[active, length] = indices
+            char_probs[active, length] = values
+            length += 1
+
+            finished = indices == eos_token
+            if finished.any():
+                keep = (~finished).nonzero().squeeze(1)
+                active = active[keep]
+                if state is not None:
+                    state.index_select(keep)
+
+            if len(active) == 0:
+                break
 
-            values, indices  = torch.topk(output, 5)
-            
-            indices = indices[:, -1, 0]
-            indices = indices.tolist()
-            
-            values = values[:, -1, 0]
-            values = values.tolist()
-            char_probs.append(values)
+        translated_sentence = translated_sentence[:, :length]
+        token_probs = char_probs[:, :length]
 
-            translated_sentence.append(indices)   
-            max_length += 1
+        mask = translated_sentence > 3
+        char_probs = (token_probs*mask).sum(-1)/mask.sum(-1)
 
-            del output
+        translated_sentence = translated_sentence.cpu().numpy()
+        char_probs = char_probs.cpu().numpy()
 
-        translated_sentence = np.asarray(translated_sentence).T
-        
-        char_probs = np.asarray(char_probs).T
-        char_probs = np.multiply(char_probs, translated_sentence>3)
-        char_probs = np.sum(char_probs, axis=-1)/(char_probs>0).sum(-1)
-    
+    if return_char_probs:
+        return translated_sentence, char_probs, token_probs.cpu().numpy()
     return translated_sentence, char_probs
 
 
@@ -141,23 +328,62 @@ def resize(w, h, expected_height, image_min_width, image_max_width):
     return new_w, expected_height
 
 def process_image(image, image_height, image_min_width, image_max_width):
+    """
+    Resize a PIL image or an RGB uint8 array (e.g. a crop view) to the model
+    height and return a float32 CxHxW array in [0, 1]
+    """
+    img = resize_image(image, image_height, image_min_width, image_max_width)
+
+    # uint8 HWC -> float32 CHW in a single pass
+    return np.multiply(img.transpose(2, 0, 1), 1/255, dtype=np.float32, order='C')
+
+def resize_image(image, image_height, image_min_width, image_max_width):
+    """Resize a PIL image or an RGB uint8 array to a uint8 HxWx3 array"""
+    if isinstance(image, np.ndarray):
+        return resize_array(image, image_height, image_min_width, image_max_width)
+
     img = image.convert('RGB')
 
     w, h = img.size
     new_w, image_height = resize(w, h, image_height, image_min_width, image_max_width)
 
     img = img.resize((new_w, image_height), Image.LANCZOS)
+    return np.asarray(img)
 
-    img = np.asarray(img).transpose(2,0, 1)
-    img = img/255
-    return img
+def resize_array(img, image_height, image_min_width, image_max_width):
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+
+    h, w = img.shape[:2]
+    new_w, image_height = resize(w, h, image_height, image_min_width, image_max_width)
+
+    # INTER_AREA antialiases when shrinking, like PIL's LANCZOS filter does
+    interpolation = cv2.INTER_AREA if image_height < h else cv2.INTER_LANCZOS4
+    return cv2.resize(img, (new_w, image_height), interpolation=interpolation)
 
 def process_input(image, image_height, image_min_width, image_max_width):
     img = process_image(image, image_height, image_min_width, image_max_width)
-    img = img[np.newaxis, ...]
-    img = torch.FloatTensor(img)
+    img = torch.from_numpy(img).unsqueeze(0)
     return img
 
+def process_batch(imgs, pad_value=255, pin_memory=False):
+    """
+    Copy resized uint8 HxWx3 arrays of equal height into one preallocated
+    uint8 NxCxHxW tensor, right-padded to the widest image (white by
+    default). Normalize it after moving it to the device, with
+    batch.float().div_(255), so only uint8 data is transferred.
+    """
+    height = imgs[0].shape[0]
+    max_width = max(img.shape[1] for img in imgs)
+
+    batch = torch.full((len(imgs), 3, height, max_width), pad_value,
+                       dtype=torch.uint8, pin_memory=pin_memory)
+    buffer = batch.numpy()
+    for i, img in enumerate(imgs):
+        buffer[i, :, :, :img.shape[1]] = img.transpose(2, 0, 1)
+
+    return batch
+
 def predict(filename, config):
     img = Image.open(filename)
     img = process_input(img)
@@ -3,37 +3,160 @@ import gdown
 import yaml
 import numpy as np
 import uuid
+import hashlib
 import requests
-import tempfile
+import torch
 from tqdm import tqdm
 
+try:
+    import safetensors.torch as safetensors_torch
+except ImportError:
+    safetensors_torch = None
+
 def download_weights(uri, cached=None, md5=None, quiet=False):
+    """
+    Resolve weights to a local file. URLs are downloaded once into the
+    weight store (or to cached, if given). The file is only verified if an
+    md5 is given (weights_md5 in the config); otherwise nothing checks it.
+    """
     if uri.startswith('http'):
-        return download(url=uri, quiet=quiet)
+        return download(url=uri, cached=cached, md5=md5, quiet=quiet)
     return uri
 
-def download(url, quiet=False):
-    tmp_dir = tempfile.gettempdir()
+def file_md5(path, chunk_size=1 << 20):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def download(url, cached=None, md5=None, quiet=False):
     filename = url.split('/')[-1]
-    full_path = os.path.join(tmp_dir, filename)
+    full_path = cached or os.path.join(get_cache_dir('weights'), filename)
     
     if os.path.exists(full_path):
-        print('Model weight {} exsits. Ignore download!'.format(full_path))
-        return full_path
-
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(full_path, 'wb') as f:
-            for chunk in tqdm(r.iter_content(chunk_size=8192)):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                #if chunk:
-                f.write(chunk)
+        if md5 is None or file_md5(full_path) == md5:
+            if not quiet:
+                print('Model weight {} exsits. Ignore download!'.format(full_path))
+            return full_path
+        print('Model weight {} does not match md5 {}. Download again!'.format(full_path, md5))
+
+    # download next to the target and rename once complete, so concurrent
+    # workers never load a partially written file
+    tmp_path = '{}.{}.tmp'.format(full_path, os.getpid())
+    try:
+        with requests.get(url, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in tqdm(r.iter_content(chunk_size=8192), disable=quiet):
+                    # If you have chunk encoded response uncomment if
+                    # and set chunk_size parameter to None.
+                    #if chunk:
+                    f.write(chunk)
+
+        if md5 is not None and file_md5(tmp_path) != md5:
+            raise ValueError('Downloaded weight {} does not match md5 {}'.format(url, md5))
+
+        os.replace(tmp_path, full_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
     return full_path
 
-def download_config(id):
+def load_weights(path, device='cpu', transform=None, tag=None):
+    """
+    Load a state dict from the weight store, memory-mapping the file where
+    possible so that workers on the same host share page-cache pages.
+
+    A .pth checkpoint is converted once to .safetensors in the weight store
+    (get_cache_dir('weights')) if safetensors is installed. The converted
+    file records the size and mtime of its source and is rebuilt when the
+    .pth changes. Without safetensors the checkpoint is loaded with
+    torch.load(mmap=True), falling back to a regular load for legacy,
+    non-zipfile checkpoints.
+
+    transform, if given, maps the checkpoint to the state dict to load
+    (e.g. with BatchNorm folded into the convs). It runs once, when the
+    store is written, and tag names it in the stored file.
+    """
+    device = torch.device(device)
+
+    if safetensors_torch is not None:
+        if path.endswith('.safetensors') and transform is None:
+            return safetensors_torch.load_file(path, device=str(device))
+
+        st_path = safetensors_path(path, tag)
+        if not is_converted_from(st_path, path, tag):
+            convert_to_safetensors(path, st_path, transform, tag)
+        # a stale copy is never loaded, even if reconversion failed
+        if is_converted_from(st_path, path, tag):
+            return safetensors_torch.load_file(st_path, device=str(device))
+
+    state_dict = read_state_dict(path, device)
+    return transform(state_dict) if transform is not None else state_dict
+
+def read_state_dict(path, device='cpu'):
+    if path.endswith('.safetensors'):
+        return safetensors_torch.load_file(path, device=str(device))
+    try:
+        return torch.load(path, map_location=device, mmap=True, weights_only=True)
+    except (RuntimeError, TypeError, ValueError):
+        return torch.load(path, map_location=device)
+
+def safetensors_path(path, tag=None):
+    """Location of the converted copy of path in the weight store"""
+    path = os.path.abspath(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    # the same file name may live in several directories
+    key = hashlib.md5(path.encode('utf-8')).hexdigest()[:8]
+    name = '-'.join(part for part in (stem, key, tag) if part)
+    return os.path.join(get_cache_dir('weights'), name + '.safetensors')
+
+def source_metadata(path, tag=None):
+    stat = os.stat(path)
+    return {'source': os.path.abspath(path),
+            'source_size': str(stat.st_size),
+            'source_mtime_ns': str(stat.st_mtime_ns),
+            'transform': tag or ''}
+
+def is_converted_from(st_path, path, tag=None):
+    """Whether st_path exists and was converted from the current contents of path"""
+    if not os.path.exists(st_path):
+        return False
+    try:
+        with safetensors_torch.safe_open(st_path, framework='pt') as f:
+            metadata = f.metadata() or {}
+    except Exception:
+        return False
+    expected = source_metadata(path, tag)
+    return all(metadata.get(k) == v for k, v in expected.items())
+
+def convert_to_safetensors(path, st_path, transform=None, tag=None):
+    try:
+        state_dict = read_state_dict(path)
+        if transform is not None:
+            state_dict = transform(state_dict)
+        state_dict = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+        tmp_path = '{}.{}.tmp'.format(st_path, os.getpid())
+        safetensors_torch.save_file(state_dict, tmp_path, metadata=source_metadata(path, tag))
+        os.replace(tmp_path, st_path)
+    except Exception as e:
+        print('Could not convert {} to safetensors: {}'.format(path, e))
+
+def get_cache_dir(*subdirs):
+    """Local cache for configs and weights, VIETOCR_CACHE_DIR overrides the default"""
+    root = os.environ.get('VIETOCR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'vietocr'))
+    path = os.path.join(root, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def download_config(id, parse=True):
     url = 'https://vocr.vn/data/vietocr/config/{}'.format(id)
-    r = requests.get(url)
+    r = requests.get(url, timeout=30)
+    r.raise_for_status()
+    if not parse:
+        return r.text
     config = yaml.safe_load(r.text)
     return config
 
@@ -0,0 +1,114 @@
+"""
+Tests for the /extract micro-batching scheduler, using a stub extractor
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+from app.Ocr_extractor.batch_scheduler import BatchScheduler, QueueFullError
+
+
+class RecordingExtractor:
+    """Stands in for OCRExtractor and records the batches it receives"""
+
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def batch_extract(self, images, min_confidence=None):
+        with self.lock:
+            self.batches.append(list(images))
+        return [{'image': image} for image in images]
+
+
+def test_concurrent_requests_share_a_batch():
+    """Requests arriving within max_wait_ms are processed together, in order"""
+    extractor = RecordingExtractor()
+    scheduler = BatchScheduler(lambda: extractor, max_batch_size=4, max_wait_ms=200)
+    scheduler.start()
+
+    async def run():
+        return await asyncio.gather(*(scheduler.submit(i) for i in range(6)))
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert [result['image'] for result in results] == list(range(6))
+    assert [len(batch) for batch in extractor.batches] == [4, 2]
+
+
+def test_batch_failure_is_raised_to_every_request():
+    """An exception from the extractor resolves all futures of the batch"""
+
+    class FailingExtractor:
+        def batch_extract(self, images, min_confidence=None):
+            raise RuntimeError("model crashed")
+
+    scheduler = BatchScheduler(FailingExtractor, max_batch_size=4, max_wait_ms=50)
+    scheduler.start()
+
+    async def run():
+        return await asyncio.gather(*(scheduler.submit(i) for i in range(2)), return_exceptions=True)
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_full_queue_rejects_new_requests():
+    """Beyond max_queue_size waiting requests submit raises QueueFullError"""
+
+    class BlockingExtractor:
+        def __init__(self):
+            self.started = threading.Event()
+            self.release = threading.Event()
+
+        def batch_extract(self, images, min_confidence=None):
+            self.started.set()
+            self.release.wait(5)
+            return [{'image': image} for image in images]
+
+    extractor = BlockingExtractor()
+    scheduler = BatchScheduler(lambda: extractor, max_batch_size=1, max_wait_ms=0, max_queue_size=1)
+    scheduler.start()
+
+    async def run():
+        running = asyncio.ensure_future(scheduler.submit(0))
+        await asyncio.get_running_loop().run_in_executor(None, extractor.started.wait, 5)
+        reservation = scheduler.reserve()
+
+        # the reserved slot counts as queued until it is used or released
+        with pytest.raises(QueueFullError):
+            scheduler.reserve()
+        with pytest.raises(QueueFullError):
+            await scheduler.submit(2)
+        reservation.release()
+        reservation.release()
+        reservation = scheduler.reserve()
+
+        queued = asyncio.ensure_future(scheduler.submit(1, reservation=reservation))
+        await asyncio.sleep(0)
+        reservation.release()
+
+        with pytest.raises(QueueFullError):
+            scheduler.reserve()
+        with pytest.raises(QueueFullError):
+            await scheduler.submit(2)
+
+        extractor.release.set()
+        return await asyncio.gather(running, queued)
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        extractor.release.set()
+        scheduler.stop()
+
+    assert [result['image'] for result in results] == [0, 1]
@@ -0,0 +1,50 @@
+"""
+Tests for offline VietOCR config resolution
+"""
+
+import pytest
+
+import app.vietocr.vietocr.tool.config as config_module
+from app.vietocr.vietocr.tool.config import Cfg
+
+
+def no_network(*args, **kwargs):
+    raise AssertionError("config loading must not touch the network")
+
+
+def test_load_bundled_config_offline(monkeypatch):
+    """vgg_transformer resolves from the bundled yml files"""
+    monkeypatch.setattr(config_module, 'download_config', no_network)
+
+    config = Cfg.load_config_from_name('vgg_transformer')
+
+    assert config['backbone'] == 'vgg19_bn'
+    assert config['transformer']['d_model'] == 256
+    assert config['dataset']['image_height'] == 32
+
+
+def test_loaded_configs_are_independent(monkeypatch):
+    """Callers may modify a loaded config without affecting later loads"""
+    monkeypatch.setattr(config_module, 'download_config', no_network)
+
+    config = Cfg.load_config_from_name('vgg_transformer')
+    config['cnn']['pretrained'] = False
+
+    assert Cfg.load_config_from_name('vgg_transformer')['cnn']['pretrained'] is True
+
+
+def test_missing_config_requires_explicit_download(monkeypatch, tmp_path):
+    """Configs that are neither bundled nor cached are only downloaded on request"""
+    monkeypatch.setenv('VIETOCR_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(config_module, 'download_config', lambda fname, parse=False: 'backbone: custom\n')
+    monkeypatch.setattr(config_module, '_parsed_configs', {})
+
+    with pytest.raises(FileNotFoundError):
+        config_module.load_named_config('custom.yml')
+
+    assert config_module.load_named_config('custom.yml', allow_download=True) == {'backbone': 'custom'}
+
+    # served from the on-disk cache afterwards
+    monkeypatch.setattr(config_module, 'download_config', no_network)
+    monkeypatch.setattr(config_module, '_parsed_configs', {})
+    assert config_module.load_named_config('custom.yml') == {'backbone': 'custom'}
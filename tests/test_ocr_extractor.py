@@ -0,0 +1,431 @@
+"""
+Pipeline tests for OCRExtractor with stub YOLO and VietOCR models
+"""
+
+import io
+import threading
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from ultralytics.engine.results import Results
+
+from app.Ocr_extractor.ocr_extractor import OCRExtractor, ScanImage
+
+CLASS_MAPPING = {
+    0: 'k_name',
+    1: 'Họ và tên',
+    2: 'k_m_name',
+    3: 'Họ và tên Mẹ',
+    4: 'k_c_name',
+    5: 'Họ và tên Cha',
+    6: 'object',
+}
+
+# x1, y1, x2, y2, conf, cls
+BOXES = [
+    [10, 10, 120, 40, 0.90, 1],
+    [10, 50, 200, 80, 0.80, 3],
+    [10, 90, 150, 120, 0.70, 5],
+    [5, 5, 60, 30, 0.95, 4],
+    [12, 12, 118, 38, 0.50, 1],    # duplicate with lower confidence
+    [30, 30, 20, 20, 0.90, 0],     # invalid box
+]
+
+
+class StubYolo:
+    """Returns BOXES for every image and records the batch sizes it sees"""
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, images, verbose=False, conf=0.3):
+        if not isinstance(images, list):
+            images = [images]
+        self.calls.append(len(images))
+        names = {i: name for i, name in CLASS_MAPPING.items()}
+        return [Results(image, path='', names=names, boxes=torch.tensor(BOXES)) for image in images]
+
+
+class StubPredictor:
+    """Reads the crop width as text, so results depend on the bbox"""
+
+    config = {'dataset': {'image_height': 32}}
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, img, return_prob=False):
+        self.calls.append(1)
+        return f'nguyen {img.shape[1]} van'
+
+    def predict_batch(self, imgs, return_prob=False, pad_width=False, return_char_probs=False):
+        self.calls.append(len(imgs))
+        texts = [f'nguyen {img.shape[1]} van' for img in imgs]
+        if return_char_probs:
+            return texts, [0.9] * len(texts), [[0.9] * len(text) for text in texts]
+        return texts
+
+    def quantize(self, calibration_images=None, observer_stats=None):
+        self.calibration_images = calibration_images
+        self.observer_stats = observer_stats
+
+
+def build_extractor(batch_size=4):
+    extractor = OCRExtractor.__new__(OCRExtractor)
+    extractor.device = 'cpu'
+    extractor.yolo_model = StubYolo()
+    extractor._yolo_lock = threading.Lock()
+    extractor.ocr_predictor = StubPredictor()
+    extractor.class_mapping = CLASS_MAPPING
+    extractor.extract_fields = {'Họ và tên Mẹ', 'k_c_name', 'k_m_name', 'Họ và tên Cha', 'Họ và tên'}
+    extractor.batch_size = batch_size
+    extractor.return_labels = False
+    extractor.confidence_calibration = None
+    extractor.text_height_ratio = None
+    return extractor
+
+
+def build_images(n):
+    return [
+        Image.fromarray((np.random.RandomState(i).rand(200, 300, 3) * 255).astype('uint8'))
+        for i in range(n)
+    ]
+
+
+def test_detection_runs_one_thread_at_a_time():
+    """Scheduler workers share the YOLO model, so its predict calls never overlap"""
+
+    class ConcurrencyYolo(StubYolo):
+        def __init__(self):
+            super().__init__()
+            self.running = 0
+            self.max_running = 0
+
+        def predict(self, images, verbose=False, conf=0.3):
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            time.sleep(0.02)
+            self.running -= 1
+            return super().predict(images, verbose, conf)
+
+    extractor = build_extractor()
+    extractor.yolo_model = ConcurrencyYolo()
+    image = np.zeros((200, 300, 3), dtype=np.uint8)
+    threads = [threading.Thread(target=extractor.detect_fields_batch, args=([image],)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert extractor.yolo_model.calls == [1] * 4
+    assert extractor.yolo_model.max_running == 1
+
+
+def test_extract_info_keeps_best_box_per_field():
+    """Duplicates and invalid boxes are dropped, fields are read in one batch"""
+    extractor = build_extractor()
+
+    result = extractor.extract_info(build_images(1)[0])
+
+    assert set(result) == {'Họ và tên', 'Họ và tên Mẹ', 'Họ và tên Cha'}
+    assert result['Họ và tên']['bbox'] == [10, 10, 120, 40]
+    assert result['Họ và tên']['value'] == 'NGUYEN 114 VAN'
+    # k_c_name is read for the swap rule but not returned
+    assert extractor.ocr_predictor.calls == [4]
+
+
+def test_batch_extract_matches_extract_info():
+    """batch_extract runs YOLO per chunk and returns results in input order"""
+    images = build_images(5)
+    expected = [build_extractor().extract_info(image) for image in images]
+
+    extractor = build_extractor(batch_size=4)
+    results = extractor.batch_extract(images)
+
+    assert results == expected
+    assert extractor.yolo_model.calls == [4, 1]
+    assert extractor.ocr_predictor.calls == [16, 4]
+
+
+def test_labels_are_skipped_without_routing_need():
+    """Label crops are not recognized when a parent field is missing"""
+    extractor = build_extractor()
+    detections = [
+        {'bbox': [10, 10, 120, 40], 'confidence': 0.9, 'class_id': 1, 'field_name': 'Họ và tên'},
+        {'bbox': [10, 50, 200, 80], 'confidence': 0.8, 'class_id': 3, 'field_name': 'Họ và tên Mẹ'},
+        {'bbox': [5, 50, 60, 80], 'confidence': 0.9, 'class_id': 2, 'field_name': 'k_m_name'},
+        {'bbox': [5, 90, 60, 120], 'confidence': 0.9, 'class_id': 4, 'field_name': 'k_c_name'},
+    ]
+
+    to_read, swap = extractor.plan_fields(detections)
+
+    assert [d['field_name'] for d in to_read] == ['Họ và tên', 'Họ và tên Mẹ']
+    assert swap is False
+
+
+def test_parent_swap_from_geometry():
+    """A father label on the mother value's row swaps parents without OCR"""
+    extractor = build_extractor()
+    mother = {'bbox': [80, 50, 200, 80], 'confidence': 0.8, 'class_id': 3, 'field_name': 'Họ và tên Mẹ'}
+    father = {'bbox': [80, 90, 200, 120], 'confidence': 0.7, 'class_id': 5, 'field_name': 'Họ và tên Cha'}
+    label = {'bbox': [5, 52, 70, 78], 'confidence': 0.9, 'class_id': 4, 'field_name': 'k_c_name'}
+
+    to_read, swap = extractor.plan_fields([mother, father, label])
+    result = extractor._build_info(to_read, [('tran thi c', [0.9] * 10), ('nguyen van b', [0.9] * 12)], swap)
+
+    assert to_read == [mother, father]
+    assert swap is True
+    assert result['Họ và tên Cha']['value'] == 'TRAN THI C'
+    assert result['Họ và tên Mẹ']['value'] == 'NGUYEN VAN B'
+
+
+def test_mother_label_alone_does_not_swap():
+    """Without k_c_name the text rule never swaps, so geometry does not either"""
+    extractor = build_extractor()
+    mother = {'bbox': [80, 50, 200, 80], 'confidence': 0.8, 'class_id': 3, 'field_name': 'Họ và tên Mẹ'}
+    father = {'bbox': [80, 90, 200, 120], 'confidence': 0.7, 'class_id': 5, 'field_name': 'Họ và tên Cha'}
+    label = {'bbox': [5, 92, 70, 118], 'confidence': 0.9, 'class_id': 2, 'field_name': 'k_m_name'}
+
+    to_read, swap = extractor.plan_fields([mother, father, label])
+
+    assert to_read == [mother, father]
+    assert swap is False
+
+
+def test_decode_image_matches_pil():
+    """Upload bytes decode to the same RGB array as the PIL path"""
+    image = build_images(1)[0]
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+
+    decoded = OCRExtractor.decode_image(buffer.getvalue())
+
+    assert decoded.dtype == np.uint8
+    np.testing.assert_array_equal(decoded, build_extractor().preprocess_image(image))
+
+
+def test_extract_info_accepts_decoded_array():
+    """Arrays from decode_image give the same result as PIL images"""
+    image = build_images(1)[0]
+
+    assert build_extractor().extract_info(np.asarray(image)) == build_extractor().extract_info(image)
+
+
+def encode_jpeg(width, height):
+    image = Image.fromarray((np.random.RandomState(0).rand(height, width, 3) * 255).astype('uint8'))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def count_decodes(monkeypatch):
+    calls = []
+    decode = OCRExtractor.decode_image
+
+    def counting(contents, reduction=1):
+        calls.append(reduction)
+        return decode(contents, reduction)
+
+    monkeypatch.setattr(OCRExtractor, 'decode_image', staticmethod(counting))
+    return calls
+
+
+def test_large_jpeg_is_decoded_once(monkeypatch):
+    """Without a text height estimate the scan is decoded once at full size and resized for detection"""
+    decodes = count_decodes(monkeypatch)
+    extractor = build_extractor()
+    image = extractor.load_image(encode_jpeg(2600, 1800))
+
+    assert image.reduction == 1
+    assert image.image.shape == (1800, 2600, 3)
+    assert image.detection.shape == (443, 640, 3)
+
+    result = extractor.extract_info(image)
+
+    # BOXES are in detection coordinates, scaled back on the way out
+    bbox = image.to_full_resolution([10, 10, 120, 40])
+    assert result['Họ và tên']['bbox'] == bbox
+    assert result['Họ và tên']['value'] == f'NGUYEN {bbox[2] - bbox[0] + 4} VAN'
+    assert extractor.batch_extract([image]) == [result]
+    assert decodes == [1]
+
+
+def test_reduced_decode_follows_text_height(monkeypatch):
+    """With a text height ratio, large scans are decoded once at a reduced size"""
+    decodes = count_decodes(monkeypatch)
+    extractor = build_extractor()
+    extractor.text_height_ratio = 0.06
+
+    # BOXES are ~240 px tall at full size, 120 px at 1/2, 60 px at 1/4
+    image = extractor.load_image(encode_jpeg(5200, 3600))
+    assert image.reduction == 2
+    assert image.image.shape == (1800, 2600, 3)
+
+    decodes.clear()
+    result = extractor.extract_info(image)
+    assert decodes == []
+    assert result['Họ và tên']['bbox'] == image.to_full_resolution([10, 10, 120, 40])
+
+
+def test_small_text_is_decoded_again(monkeypatch):
+    """Fields smaller than expected are cropped from a decode that keeps them readable"""
+    decodes = count_decodes(monkeypatch)
+    extractor = build_extractor()
+    extractor.text_height_ratio = 0.5
+    image = extractor.load_image(encode_jpeg(2600, 1800))
+    assert image.reduction == 4
+
+    reference = build_extractor().extract_info(build_extractor().load_image(encode_jpeg(2600, 1800)))
+    decodes.clear()
+    assert extractor.extract_info(image) == reference
+    # BOXES are ~120 px tall at full size, 61 px at 1/2
+    assert decodes == [1]
+
+
+def test_crops_do_not_depend_on_previous_scans():
+    """The same upload gives the same crops whatever was processed before"""
+    extractor = build_extractor()
+    extractor.text_height_ratio = 0.06
+    contents = encode_jpeg(5200, 3600)
+
+    first = extractor.field_crops(contents)
+    extractor.field_crops(encode_jpeg(2600, 1800))
+    second = extractor.field_crops(contents)
+
+    assert len(first) == len(second)
+    assert all(np.array_equal(a, b) for a, b in zip(first, second))
+
+
+def test_small_jpeg_is_decoded_once():
+    """Images close to the detection size are not reduced"""
+    image = ScanImage(encode_jpeg(800, 600), OCRExtractor.DETECTION_SIZE, text_height_ratio=0.5)
+
+    assert image.reduction == 1
+    assert image.detection.shape == (480, 640, 3)
+    assert image.recognition_image([[0, 0, 100, 40]])[0] is image.image
+
+
+def test_fields_carry_recognition_confidence():
+    """Per-character and field confidences come from the same recognition pass"""
+    extractor = build_extractor()
+
+    result = extractor.extract_info(build_images(1)[0])
+    info = result['Họ và tên']
+
+    assert info['raw_value'] == 'nguyen 114 van'
+    assert info['char_confidences'] == [0.9] * len('nguyen 114 van')
+    assert abs(info['ocr_confidence'] - 0.9) < 1e-9
+    assert abs(info['field_score'] - 0.9 * 0.9) < 1e-6
+    # without a calibration the confidence is the raw score
+    assert info['field_confidence'] == info['field_score']
+
+
+def test_field_confidence_calibration():
+    """Calibration fitted on reviewed fields maps scores to observed accuracy"""
+    rng = np.random.RandomState(0)
+    scores = rng.uniform(0.05, 0.95, 4000)
+    logit = 2.0 * np.log(scores / (1 - scores)) - 1.0
+    correct = rng.rand(len(scores)) < 1 / (1 + np.exp(-logit))
+
+    slope, intercept = OCRExtractor.fit_confidence_calibration(scores, correct)
+    assert abs(slope - 2.0) < 0.2 and abs(intercept + 1.0) < 0.2
+
+    extractor = build_extractor()
+    extractor.confidence_calibration = (slope, intercept)
+    info = extractor.extract_info(build_images(1)[0])['Họ và tên']
+    assert info['field_confidence'] == extractor.calibrate_confidence(info['field_score'])
+    expected = 1 / (1 + np.exp(1.0 - 2.0 * np.log(0.81 / 0.19)))
+    assert abs(info['field_confidence'] - expected) < 0.02
+
+
+def test_min_confidence_skips_low_confidence_detections():
+    """Fields detected below min_confidence are not recognized and need review"""
+    extractor = build_extractor()
+
+    result = extractor.extract_info(build_images(1)[0], min_confidence=0.75)
+    marked = OCRExtractor.mark_for_review(result, 0.75)
+
+    # Họ và tên Cha (0.70) is skipped; the label crop is still read for the swap rule
+    assert extractor.ocr_predictor.calls == [3]
+    assert result['Họ và tên Cha']['value'] is None
+    assert marked['Họ và tên Cha']['needs_review'] is True
+    assert marked['Họ và tên']['needs_review'] is False
+    assert marked['Họ và tên Mẹ']['needs_review'] is True
+    assert extractor.batch_extract([build_images(1)[0]], min_confidence=0.75) == [result]
+
+
+def test_onnx_detector_matches_torch_on_sample(tmp_path):
+    """The extractor's ONNX Runtime detector gives the torch outputs on a bundled certificate"""
+    pytest.importorskip('onnxruntime')
+    from ultralytics import YOLO
+
+    pt_path = str(tmp_path / 'best.pt')
+    YOLO('yolo11n.yaml').save(pt_path)
+
+    extractor = build_extractor()
+    extractor.backend = 'onnx'
+    extractor.intra_op_threads = 2
+    extractor.inter_op_threads = 0
+    detector = extractor.yolo_model = extractor._load_yolo(pt_path)
+    session = detector.predictor.model.backend.session
+    assert session.get_session_options().intra_op_num_threads == 2
+
+    sample = sorted((Path(__file__).parent.parent / 'bronze_bvcare_birth_cert_raw').iterdir())[0]
+    img = OCRExtractor.decode_image(sample.read_bytes())
+    scale = OCRExtractor.DETECTION_SIZE / max(img.shape[:2])
+    img = cv2.resize(img, (round(img.shape[1] * scale / 32) * 32, round(img.shape[0] * scale / 32) * 32))
+    x = torch.from_numpy(img).permute(2, 0, 1)[None].float() / 255
+
+    with torch.no_grad():
+        expected = YOLO(pt_path).model.eval()(x)[0].numpy()
+    output = session.run(None, {session.get_inputs()[0].name: x.numpy()})[0]
+
+    assert output.shape == expected.shape
+    assert np.allclose(output, expected, rtol=1e-3, atol=1e-2)
+    assert extractor.detect_fields(img) == []
+
+
+def test_quantize_ocr_calibrates_on_field_crops(tmp_path):
+    """INT8 calibration uses the crops extract_info would read from each scan"""
+    for name in ('a.jpg', 'b.JPG'):
+        (tmp_path / name).write_bytes(encode_jpeg(300, 200))
+    (tmp_path / 'notes.txt').write_text('not a scan')
+
+    extractor = build_extractor()
+    extractor.quantize_ocr(str(tmp_path))
+
+    crops = extractor.ocr_predictor.calibration_images
+    assert extractor.int8
+    assert len(crops) == 8
+    assert sorted(crop.shape[1] for crop in crops[:4]) == sorted(crop.shape[1] for crop in crops[4:])
+
+
+def test_quantize_ocr_without_calibration_dir(tmp_path):
+    """A missing calibration directory falls back to quantizing the Linear layers only"""
+    extractor = build_extractor()
+    extractor.quantize_ocr(str(tmp_path / 'missing'))
+
+    assert extractor.int8
+    assert extractor.calibration_dir is None
+    assert extractor.ocr_predictor.calibration_images == []
+
+
+def test_quantize_ocr_prefers_offline_stats(tmp_path):
+    """Activation ranges calibrated offline are used without reading any scan"""
+    stats = {'0.activation_post_process.min_val': torch.tensor(0.0)}
+    path = tmp_path / 'stats.pt'
+    torch.save(stats, path)
+    (tmp_path / 'a.jpg').write_bytes(encode_jpeg(300, 200))
+
+    extractor = build_extractor()
+    extractor.quantize_ocr(str(tmp_path), str(path))
+
+    assert extractor.ocr_predictor.calibration_images == []
+    assert extractor.ocr_predictor.observer_stats.keys() == stats.keys()
+    assert extractor.calibration_stats == str(path)
+    assert extractor.calibration_dir is None
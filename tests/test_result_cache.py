@@ -0,0 +1,100 @@
+"""
+Tests for the /extract result cache
+"""
+
+import os
+import time
+
+from app.Ocr_extractor.result_cache import ResultCache
+
+RESULT = {'Họ và tên': {'value': 'NGUYỄN VĂN A', 'confidence': 0.9, 'bbox': [1, 2, 3, 4]}}
+
+
+def test_key_depends_on_content_and_version():
+    """The same bytes under another model version get a different key"""
+    key = ResultCache.make_key(b'image', 'v1')
+
+    assert key == ResultCache.make_key(b'image', 'v1')
+    assert key != ResultCache.make_key(b'image', 'v2')
+    assert key != ResultCache.make_key(b'other', 'v1')
+
+
+def test_lru_eviction_and_counters():
+    """The least recently used entry is evicted first"""
+    cache = ResultCache(max_entries=2)
+    cache.put('a', RESULT)
+    cache.put('b', RESULT)
+    assert cache.get('a') == RESULT
+    cache.put('c', RESULT)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == RESULT
+    assert cache.get('c') == RESULT
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 1
+
+
+def test_ttl_expiry():
+    """Entries older than ttl_seconds are not served"""
+    cache = ResultCache(ttl_seconds=0.05)
+    cache.put('a', RESULT)
+    assert cache.get('a') == RESULT
+
+    time.sleep(0.1)
+    assert cache.get('a') is None
+
+
+def test_persistence(tmp_path):
+    """Entries written to persist_dir are served by a new cache instance"""
+    ResultCache(persist_dir=str(tmp_path)).put('a', RESULT)
+
+    cache = ResultCache(persist_dir=str(tmp_path))
+    assert cache.get('a') == RESULT
+    assert cache.stats()['entries'] == 1
+
+
+def test_memory_lookup_leaves_misses_to_the_disk_tier(tmp_path):
+    """get_memory only counts a miss when there is no disk tier to ask next"""
+    ResultCache(persist_dir=str(tmp_path)).put('a', RESULT)
+
+    cache = ResultCache(persist_dir=str(tmp_path))
+    assert cache.get_memory('a') is None
+    assert cache.get_disk('a') == RESULT
+    assert cache.get_memory('a') == RESULT
+    assert cache.get_memory('b') is None
+    assert cache.get_disk('b') is None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+    memory_only = ResultCache()
+    assert memory_only.get_memory('a') is None
+    assert memory_only.stats()['misses'] == 1
+
+
+def test_sweep_bounds_the_disk_store(tmp_path):
+    """Expired files and the oldest files beyond max_disk_entries are deleted"""
+    cache = ResultCache(ttl_seconds=3600, persist_dir=str(tmp_path), max_disk_entries=2)
+    for i, key in enumerate('abcd'):
+        cache.put(key, RESULT)
+        # a: expired, b: oldest of the fresh entries
+        age = 7200 if key == 'a' else 40 - i
+        os.utime(tmp_path / f'{key}.json', (time.time() - age,) * 2)
+
+    assert cache.sweep() == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['c.json', 'd.json']
+
+
+def test_put_sweeps_at_most_once_per_interval(tmp_path):
+    """Adding entries sweeps the directory, rate limited by sweep_interval_seconds"""
+    cache = ResultCache(persist_dir=str(tmp_path), max_disk_entries=1, sweep_interval_seconds=3600)
+    cache.put('a', RESULT)
+    os.utime(tmp_path / 'a.json', (time.time() - 10,) * 2)
+    cache.put('b', RESULT)
+    cache.put('c', RESULT)
+
+    # the first put swept, the next ones are within the interval
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['a.json', 'b.json', 'c.json']
+
+    cache.sweep_interval = 0
+    cache.put('d', RESULT)
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,65 @@
+"""
+Tests for the pre-fork supervisor, with plain forked processes as workers
+"""
+
+import os
+import signal
+import threading
+import time
+
+from app.serve import supervise
+
+
+def fork_worker(seconds, status=0):
+    """Fork a child that sleeps for seconds and exits with status"""
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        time.sleep(seconds)
+        os._exit(status)
+    return pid
+
+
+def test_crashed_worker_is_restarted_until_sigterm():
+    """A worker that exits is respawned; SIGTERM stops every worker cleanly"""
+    spawned = []
+
+    def spawn():
+        # the first worker crashes, the others keep running
+        pid = fork_worker(0 if not spawned else 30, status=1)
+        spawned.append(pid)
+        return pid
+
+    timer = threading.Timer(1.0, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    start = time.monotonic()
+    try:
+        status = supervise(spawn, workers=2, backoff=0.2)
+    finally:
+        timer.cancel()
+
+    assert status == 0
+    assert len(spawned) == 3
+    assert time.monotonic() - start < 10
+    for pid in spawned:
+        try:
+            os.kill(pid, 0)
+            raise AssertionError(f"worker {pid} still running")
+        except ProcessLookupError:
+            pass
+
+
+def test_failing_workers_back_off_and_give_up():
+    """Workers failing at start up are restarted with growing delays, up to max_restarts"""
+    spawned = []
+
+    def spawn():
+        spawned.append(time.monotonic())
+        return fork_worker(0, status=1)
+
+    status = supervise(spawn, workers=1, max_restarts=3, backoff=0.1)
+
+    assert status == 1
+    assert len(spawned) == 4
+    delays = [b - a for a, b in zip(spawned, spawned[1:])]
+    assert delays[0] >= 0.1 and delays[1] >= 0.2 and delays[2] >= 0.4
@@ -0,0 +1,512 @@
+"""
+Decoding tests for VietOCR, run against a small randomly initialised model
+"""
+
+import copy
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from app.vietocr.vietocr.model.seqmodel.transformer import LanguageTransformer
+from app.vietocr.vietocr.model.transformerocr import VietOCR
+from PIL import Image
+
+from app.vietocr.vietocr.model.vocab import Vocab
+from app.vietocr.vietocr.tool.export import export_model, export_onnx, load_exported, load_onnx
+from app.vietocr.vietocr.tool.quantize import accuracy_report
+from app.vietocr.vietocr.tool.predictor import Predictor
+from app.vietocr.vietocr.tool import utils
+from app.vietocr.vietocr.tool.translate import (
+    batch_translate_beam_search, beam_search, process_batch, process_image, process_input,
+    resize_image, translate, translate_beam_search,
+)
+
+VOCAB_SIZE = 40
+D_MODEL = 32
+
+
+def build_transformer():
+    torch.manual_seed(0)
+    transformer = LanguageTransformer(VOCAB_SIZE, D_MODEL, 4, 2, 2, 64, 128, 0.1, 0.1)
+    return transformer.eval()
+
+
+CNN_ARGS = {
+    'ss': [[2, 2], [2, 2], [2, 1], [2, 1], [1, 1]],
+    'ks': [[2, 2], [2, 2], [2, 1], [2, 1], [1, 1]],
+    'hidden': D_MODEL,
+    'pretrained': False,
+}
+TRANSFORMER_ARGS = {
+    'd_model': D_MODEL, 'nhead': 4,
+    'num_encoder_layers': 2, 'num_decoder_layers': 2,
+    'dim_feedforward': 64, 'max_seq_length': 128,
+    'pos_dropout': 0.1, 'trans_dropout': 0.1,
+}
+
+
+def build_vietocr():
+    torch.manual_seed(0)
+    model = VietOCR(VOCAB_SIZE, 'vgg11_bn', CNN_ARGS, TRANSFORMER_ARGS)
+    # spread the output layer so greedy decoding produces varied tokens and
+    # let EOS compete with token 3 so rows finish at different steps
+    fc = model.transformer.fc
+    with torch.no_grad():
+        torch.nn.init.normal_(fc.weight, std=2.0)
+        fc.weight[2] = fc.weight[3]
+        fc.weight[2, :5] += 1.0
+        fc.bias[2] = fc.bias[3] - 0.5
+    return model.eval()
+
+
+def build_images():
+    torch.manual_seed(1)
+    return torch.stack([
+        torch.zeros(3, 32, 96),
+        torch.ones(3, 32, 96),
+        torch.rand(3, 32, 96),
+        torch.rand(3, 32, 96)*0.2,
+        torch.linspace(0, 1, 96).expand(3, 32, 96),
+    ])
+
+
+def reference_translate(img, model, max_seq_length=128, sos_token=1, eos_token=2):
+    """Greedy decoding that re-runs the full prefix every step"""
+    with torch.no_grad():
+        memory = model.transformer.forward_encoder(model.cnn(img))
+        translated_sentence = [[sos_token]*len(img)]
+        for _ in range(max_seq_length + 1):
+            tgt_inp = torch.LongTensor(translated_sentence)
+            output, memory = model.transformer.forward_decoder(tgt_inp, memory)
+            indices = output[:, -1].argmax(-1).tolist()
+            translated_sentence.append(indices)
+            if all(np.any(np.asarray(translated_sentence).T == eos_token, axis=1)):
+                break
+
+    return np.asarray(translated_sentence).T
+
+
+def test_decoder_step_matches_full_prefix():
+    """Incremental decoding reproduces forward_decoder logits at every step"""
+    transformer = build_transformer()
+    memory = torch.randn(20, 3, D_MODEL)
+    tgt = torch.randint(4, VOCAB_SIZE, (12, 3))
+
+    with torch.no_grad():
+        full, _ = transformer.forward_decoder(tgt, memory)
+        state = transformer.init_decoder_state(memory)
+        steps = []
+        for t in range(tgt.shape[0]):
+            output, state = transformer.forward_decoder_step(tgt[:t+1], state)
+            steps.append(output)
+
+    assert torch.allclose(full, torch.cat(steps, dim=1), atol=1e-5)
+
+
+def test_translate_matches_reference():
+    """translate() decodes the same tokens as the full-prefix greedy loop"""
+    model = build_vietocr()
+    img = build_images()
+
+    sents, probs = translate(img, model, max_seq_length=16)
+    expected = reference_translate(img, model, max_seq_length=16)
+
+    assert sents.shape == expected.shape
+    for sent, ref in zip(sents.tolist(), expected.tolist()):
+        end = ref.index(2) + 1 if 2 in ref else len(ref)
+        assert sent[:end] == ref[:end]
+        assert all(token == 0 for token in sent[end:])
+    assert probs.shape == (len(img),)
+
+
+def test_translate_batch_matches_single():
+    """Dropping finished rows from a batch does not change any row's result"""
+    model = build_vietocr()
+    img = build_images()
+
+    sents, probs = translate(img, model, max_seq_length=16)
+
+    for i in range(len(img)):
+        sent, prob = translate(img[i:i+1], model, max_seq_length=16)
+        assert sents[i, :sent.shape[1]].tolist() == sent[0].tolist()
+        assert np.allclose(probs[i], prob[0], atol=1e-5, equal_nan=True)
+
+
+def test_process_image_array_matches_pil():
+    """Crop views are resized with OpenCV to the same float32 layout as PIL images"""
+    image = (np.random.RandomState(0).rand(120, 400, 3) * 255).astype('uint8')
+    crop = image[10:74, 20:300]
+
+    from_array = process_image(crop, 32, 32, 512)
+    from_pil = process_image(Image.fromarray(crop), 32, 32, 512)
+
+    assert from_array.dtype == np.float32
+    assert from_array.shape == from_pil.shape == (3, 32, 140)
+    assert from_array.flags['C_CONTIGUOUS']
+    assert np.abs(from_array.mean() - from_pil.mean()) < 0.01
+
+
+def pad_images(imgs, pad_value=1.0):
+    """Right-pad 1xCxHxW tensors to the widest one, white like the paper around text"""
+    max_width = max(img.shape[-1] for img in imgs)
+    batch = imgs[0].new_full((len(imgs),) + tuple(imgs[0].shape[1:-1]) + (max_width,), pad_value)
+    for i, img in enumerate(imgs):
+        batch[i, ..., :img.shape[-1]] = img[0]
+    return batch
+
+
+def test_process_batch_matches_per_image_preprocessing():
+    """The uint8 batch buffer normalizes to the padded per-image tensors"""
+    rng = np.random.RandomState(0)
+    crops = [(rng.rand(40, w, 3) * 255).astype('uint8') for w in (90, 200, 150)]
+
+    resized = [resize_image(crop, 32, 32, 512) for crop in crops]
+    batch = process_batch(resized)
+
+    expected = pad_images([process_input(crop, 32, 32, 512) for crop in crops])
+
+    assert batch.dtype == torch.uint8
+    assert batch.shape == expected.shape
+    torch.testing.assert_close(batch.float().div_(255), expected)
+
+
+def test_padding_mask_hides_padded_positions():
+    """Encoding and decoding a padded batch with a key padding mask matches the unpadded rows"""
+    transformer = build_transformer()
+    src = torch.randn(20, 2, D_MODEL)
+    padded = torch.cat([src, torch.randn(8, 2, D_MODEL)])
+    mask = torch.zeros(2, 28, dtype=torch.bool)
+    mask[:, 20:] = True
+    tgt = torch.randint(4, VOCAB_SIZE, (6, 2))
+
+    with torch.no_grad():
+        memory = transformer.forward_encoder(src)
+        padded_memory = transformer.forward_encoder(padded, src_key_padding_mask=mask)
+
+        expected, _ = transformer.forward_decoder(tgt, memory)
+        full, _ = transformer.forward_decoder(tgt, padded_memory, memory_key_padding_mask=mask)
+
+        state = transformer.init_decoder_state(padded_memory, mask)
+        state.index_select(torch.tensor([1, 0]))
+        steps = []
+        for t in range(tgt.shape[0]):
+            output, state = transformer.forward_decoder_step(tgt[:t+1, [1, 0]], state)
+            steps.append(output)
+
+    assert torch.allclose(padded_memory[:20], memory, atol=1e-5)
+    assert torch.allclose(full, expected, atol=1e-5)
+    assert torch.allclose(torch.cat(steps, dim=1), expected[[1, 0]], atol=1e-5)
+
+
+def test_vgg_key_padding_mask_follows_pooling():
+    """Only feature columns computed from padding are masked"""
+    model = build_vietocr()
+    img = torch.rand(2, 3, 32, 200)
+
+    mask = model.cnn.key_padding_mask(torch.tensor([90, 200]), 32, 200)
+
+    assert mask.shape == (2, model.cnn(img).shape[0])
+    assert (~mask).sum(1).tolist() == [22 * 2, 50 * 2]
+
+
+def test_translate_returns_token_probabilities():
+    """Per-token probabilities average to the returned sequence probability"""
+    model = build_vietocr()
+    img = build_images()
+
+    sents, probs, token_probs = translate(img, model, max_seq_length=16, return_char_probs=True)
+
+    assert token_probs.shape == sents.shape
+    for sent, prob, token_prob in zip(sents, probs, token_probs):
+        chars = token_prob[sent > 3]
+        if len(chars):
+            assert np.isclose(chars.mean(), prob, atol=1e-6)
+
+
+def build_predictor(beamsearch_threshold=None, model=None):
+    predictor = Predictor.__new__(Predictor)
+    predictor.model = model if model is not None else build_vietocr()
+    predictor.vocab = Vocab(''.join(chr(ord('a') + i) for i in range(VOCAB_SIZE - 4)))
+    predictor.device = 'cpu'
+    predictor.config = {
+        'device': 'cpu',
+        'dataset': {'image_height': 32, 'image_min_width': 32, 'image_max_width': 512},
+        'predictor': {'beamsearch': False, 'beamsearch_threshold': beamsearch_threshold, 'beam_size': 1},
+    }
+    return predictor
+
+
+def test_beam_search_of_one_beam_is_greedy():
+    """A single beam follows the greedy path, with the same probabilities"""
+    model = build_vietocr()
+    img = build_images()
+
+    sents, probs, token_probs = beam_search(img, model, beam_size=1, max_seq_length=16)
+    expected, expected_probs, expected_token_probs = translate(img, model, max_seq_length=16, return_char_probs=True)
+
+    assert sents.tolist() == expected.tolist()
+    assert np.allclose(probs, expected_probs, atol=1e-5, equal_nan=True)
+    assert np.allclose(token_probs, expected_token_probs, atol=1e-5)
+
+
+def test_beam_search_batch_matches_single():
+    """Images that finish early leave the batch without changing other results"""
+    model = build_vietocr()
+    img = build_images()
+
+    sents, probs, _ = beam_search(img, model, beam_size=3, max_seq_length=16)
+
+    for i in range(len(img)):
+        sent, prob, _ = beam_search(img[i:i+1], model, beam_size=3, max_seq_length=16)
+        assert sents[i, :sent.shape[1]].tolist() == sent[0].tolist()
+        assert np.allclose(probs[i], prob[0], atol=1e-5, equal_nan=True)
+
+
+def test_batch_translate_beam_search_keeps_sentence_format():
+    """Beam search helpers return SOS plus the tokens before EOS"""
+    model = build_vietocr()
+    img = build_images()
+
+    sents = batch_translate_beam_search(img, model, beam_size=3, max_seq_length=16)
+    tokens, _, _ = beam_search(img, model, beam_size=3, max_seq_length=16)
+
+    assert len(sents) == len(img)
+    for sent, row in zip(sents, tokens.tolist()):
+        assert sent[0] == 1 and 2 not in sent
+        assert sent == row[:len(sent)]
+    assert translate_beam_search(img[:1], model, beam_size=3, max_seq_length=16) == sents[0]
+
+
+def test_beam_fallback_matches_greedy_with_beam_size_one():
+    """Re-running every crop with a beam of 1 reproduces the greedy results and probabilities"""
+    rng = np.random.RandomState(0)
+    crops = [(rng.rand(32, w, 3) * 255).astype('uint8') for w in (60, 90, 140, 200)]
+
+    greedy = build_predictor().predict_batch(crops, return_char_probs=True)
+    beam = build_predictor(beamsearch_threshold=1.01).predict_batch(crops, return_char_probs=True)
+
+    assert beam[0] == greedy[0]
+    assert np.allclose(beam[1], greedy[1], atol=1e-5, equal_nan=True)
+    for beam_chars, greedy_chars in zip(beam[2], greedy[2]):
+        assert np.allclose(beam_chars, greedy_chars, atol=1e-5)
+
+
+def build_seq2seq():
+    torch.manual_seed(0)
+    seq_args = {'encoder_hidden': D_MODEL, 'decoder_hidden': D_MODEL, 'img_channel': D_MODEL, 'decoder_embedded': D_MODEL}
+    model = VietOCR(VOCAB_SIZE, 'vgg11_bn', CNN_ARGS, seq_args, seq_modeling='seq2seq')
+    # let EOS win after a few tokens so sequences end before max_seq_length
+    with torch.no_grad():
+        model.transformer.decoder.fc_out.bias[2] += 0.35
+    return model.eval()
+
+
+def test_beam_fallback_without_decoder_cache():
+    """Seq2seq models retry with the per-image beam search and keep greedy results for a beam of 1"""
+    rng = np.random.RandomState(0)
+    crops = [(rng.rand(32, w, 3) * 255).astype('uint8') for w in (60, 90, 140)]
+
+    greedy = build_predictor(model=build_seq2seq()).predict_batch(crops, return_char_probs=True)
+    predictor = build_predictor(beamsearch_threshold=1.01, model=build_seq2seq())
+    beam = predictor.predict_batch(crops, return_char_probs=True)
+
+    assert beam[0] == greedy[0]
+    assert np.allclose(beam[1], greedy[1], atol=1e-5, equal_nan=True)
+    for beam_chars, greedy_chars in zip(beam[2], greedy[2]):
+        assert np.allclose(beam_chars, greedy_chars, atol=1e-5)
+    assert predictor.predict(crops[0], return_prob=True)[0] == greedy[0][0]
+
+
+def test_exported_model_matches_eager(tmp_path):
+    """The frozen graph decodes like the eager model, for other batch sizes and widths too"""
+    model = build_vietocr()
+    path = str(tmp_path / 'recognizer.ts')
+    export_model(model, path, image_height=32, example_width=64)
+    exported = load_exported(path)
+
+    img = build_images()
+    widths = torch.tensor([96, 64, 40, 96, 80])
+    for kwargs in ({}, {'widths': widths}):
+        sents, probs, char_probs = translate(img, model, return_char_probs=True, **kwargs)
+        ex_sents, ex_probs, ex_char_probs = translate(img, exported, return_char_probs=True, **kwargs)
+        assert ex_sents.tolist() == sents.tolist()
+        assert np.allclose(ex_probs, probs, atol=1e-5, equal_nan=True)
+        assert np.allclose(ex_char_probs, char_probs, atol=1e-5)
+
+    sents, probs, _ = beam_search(img[:3], model, beam_size=3, max_seq_length=16)
+    ex_sents, ex_probs, _ = beam_search(img[:3], exported, beam_size=3, max_seq_length=16)
+    assert ex_sents.tolist() == sents.tolist()
+    assert np.allclose(ex_probs, probs, atol=1e-5, equal_nan=True)
+
+
+def test_predictor_loads_exported_model(tmp_path):
+    path = str(tmp_path / 'recognizer.ts')
+    export_model(build_vietocr(), path)
+
+    predictor = build_predictor()
+    config = dict(predictor.config, vocab=predictor.vocab.chars)
+    config['predictor'] = dict(config['predictor'], exported=path)
+    exported = Predictor(config)
+
+    rng = np.random.RandomState(0)
+    crops = [(rng.rand(32, w, 3) * 255).astype('uint8') for w in (60, 90, 140, 200)]
+    assert exported.predict_batch(crops) == predictor.predict_batch(crops)
+
+
+SAMPLES = sorted(
+    path for path in (Path(__file__).parent.parent / 'bronze_bvcare_birth_cert_raw').iterdir()
+    if path.suffix.lower() in ('.jpg', '.jpeg', '.png')
+)
+
+
+def sample_crops():
+    """Name-sized strips of the bundled sample certificates"""
+    crops = []
+    for path in SAMPLES[:3]:
+        img = np.asarray(Image.open(path).convert('RGB'))
+        h, w = img.shape[:2]
+        for top, width in ((0.3, 0.25), (0.45, 0.35), (0.6, 0.5)):
+            y, x = int(h * top), int(w * 0.1)
+            crops.append(img[y:y + h // 20, x:x + int(w * width)])
+    return crops
+
+
+def test_onnx_model_matches_eager(tmp_path):
+    """ONNX Runtime decodes like the eager model, for other batch sizes and widths too"""
+    pytest.importorskip('onnxruntime')
+    model = build_vietocr()
+    export_onnx(model, str(tmp_path), image_height=32, example_width=64)
+    onnx_model = load_onnx(str(tmp_path), intra_op_threads=1)
+
+    img = build_images()
+    widths = torch.tensor([96, 64, 40, 96, 80])
+    sents, probs, char_probs = translate(img, model, return_char_probs=True, widths=widths)
+    onnx_sents, onnx_probs, onnx_char_probs = translate(img, onnx_model, return_char_probs=True, widths=widths)
+    assert onnx_sents.tolist() == sents.tolist()
+    assert np.allclose(onnx_probs, probs, atol=1e-4, equal_nan=True)
+    assert np.allclose(onnx_char_probs, char_probs, atol=1e-4)
+
+    sents, probs, _ = beam_search(img[:1], model, beam_size=3, max_seq_length=16)
+    onnx_sents, onnx_probs, _ = beam_search(img[:1], onnx_model, beam_size=3, max_seq_length=16)
+    assert onnx_sents.tolist() == sents.tolist()
+    assert np.allclose(onnx_probs, probs, atol=1e-4, equal_nan=True)
+
+
+def test_onnx_predictor_matches_torch_on_samples(tmp_path):
+    pytest.importorskip('onnxruntime')
+    export_onnx(build_vietocr(), str(tmp_path))
+
+    predictor = build_predictor()
+    config = dict(predictor.config, vocab=predictor.vocab.chars)
+    config['predictor'] = dict(config['predictor'], exported=str(tmp_path))
+    onnx_predictor = Predictor(config)
+
+    crops = sample_crops()
+    sents, probs = predictor.predict_batch(crops, return_prob=True)
+    onnx_sents, onnx_probs = onnx_predictor.predict_batch(crops, return_prob=True)
+    assert onnx_sents == sents
+    assert np.allclose(onnx_probs, probs, atol=1e-4, equal_nan=True)
+
+
+def test_int8_predictor_stays_close_to_fp32():
+    """Quantized Linear layers and calibrated convs keep the texts of the fp32 model"""
+    crops = sample_crops()
+    reference = build_predictor()
+    quantized = build_predictor()
+    quantized.quantize(crops[:4])
+
+    vgg = quantized.model.cnn.model
+    assert len(vgg.pool_geometry()) == len(reference.model.cnn.model.pool_geometry())
+    assert not vgg.conv_blocks()
+
+    report = accuracy_report(reference, quantized, crops[4:])
+    assert report['crops'] == len(crops) - 4
+    assert report['cer'] < 0.2
+    assert report['int8_model_bytes'] < report['fp32_model_bytes'] / 2
+
+
+def test_int8_offline_stats_match_calibration():
+    """Quantizing from saved activation ranges gives the model calibrated on the crops"""
+    crops = sample_crops()
+    calibrated = build_predictor()
+    calibrated.quantize(crops[:4])
+    stats = build_predictor().calibration_stats(crops[:4])
+    from_stats = build_predictor()
+    from_stats.quantize(observer_stats=stats)
+
+    img = build_images()
+    with torch.no_grad():
+        assert torch.equal(from_stats.model.cnn(img), calibrated.model.cnn(img))
+
+
+def build_vietocr_with_batchnorm_stats():
+    model = build_vietocr()
+    torch.manual_seed(2)
+    for layer in model.cnn.model.features:
+        if isinstance(layer, torch.nn.BatchNorm2d):
+            layer.running_mean.uniform_(-0.5, 0.5)
+            layer.running_var.uniform_(0.5, 2.0)
+            torch.nn.init.uniform_(layer.weight, 0.5, 1.5)
+            torch.nn.init.uniform_(layer.bias, -0.5, 0.5)
+    return model
+
+
+def test_fused_vgg_matches_original():
+    """Folding BN and dropping identity layers keeps the backbone output"""
+    model = build_vietocr_with_batchnorm_stats()
+
+    fused = copy.deepcopy(model)
+    fused.cnn.fuse_for_inference()
+    vgg, original = fused.cnn.model, model.cnn.model
+
+    assert not any(isinstance(layer, torch.nn.BatchNorm2d) for layer in vgg.features)
+    assert len(vgg.features) < len(original.features)
+    assert isinstance(vgg.dropout, torch.nn.Identity)
+    assert vgg.output_size(32, 96) == original.output_size(32, 96)
+
+    img = build_images()
+    widths = torch.tensor([96, 64, 40, 96, 80])
+    with torch.no_grad():
+        assert torch.allclose(fused.cnn(img), model.cnn(img), atol=1e-4)
+    assert torch.equal(vgg.key_padding_mask(widths, 32, 96), original.key_padding_mask(widths, 32, 96))
+    assert translate(img, fused, widths=widths)[0].tolist() == translate(img, model, widths=widths)[0].tolist()
+
+
+def test_predictor_stores_folded_weights(monkeypatch, tmp_path):
+    """BN is folded once into the weight store and the model runs on the stored tensors"""
+    if utils.safetensors_torch is None:
+        pytest.skip('safetensors is not installed')
+    monkeypatch.setenv('VIETOCR_CACHE_DIR', str(tmp_path / 'cache'))
+    model = build_vietocr_with_batchnorm_stats()
+    path = str(tmp_path / 'model.pth')
+    torch.save(model.state_dict(), path)
+    config = {
+        'device': 'cpu', 'weights': path, 'vocab': ''.join(chr(ord('a') + i) for i in range(VOCAB_SIZE - 4)),
+        'backbone': 'vgg11_bn', 'cnn': CNN_ARGS, 'transformer': TRANSFORMER_ARGS, 'seq_modeling': 'transformer',
+    }
+
+    loaded, _ = Predictor._load_model(config)
+    stored = utils.safetensors_path(path, 'bn_folded')
+    with utils.safetensors_torch.safe_open(stored, framework='pt') as f:
+        assert f.metadata()['transform'] == 'bn_folded'
+        assert not any('running_mean' in key for key in f.keys())
+
+    # later loads map the store without folding again
+    monkeypatch.setattr(utils, 'convert_to_safetensors', None)
+    loaded, _ = Predictor._load_model(config)
+    assert all(len(block) == 2 for block in loaded.cnn.model.conv_blocks())
+
+    img = build_images()
+    with torch.no_grad():
+        assert torch.allclose(loaded.cnn(img), model.cnn(img), atol=1e-4)
+
+
+def test_int8_quantizes_fused_backbone():
+    predictor = build_predictor()
+    predictor.model.cnn.fuse_for_inference()
+    assert predictor.model.cnn.model.conv_blocks()
+
+    predictor.quantize(sample_crops()[:2])
+    assert not predictor.model.cnn.model.conv_blocks()
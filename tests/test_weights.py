@@ -0,0 +1,87 @@
+"""
+Tests for the VietOCR weight store
+"""
+
+import hashlib
+import os
+
+import pytest
+import torch
+
+import app.vietocr.vietocr.tool.utils as utils
+
+PAYLOAD = b'weights' * 1000
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+def test_download_verifies_md5(monkeypatch, tmp_path):
+    """Downloads are checked against md5 and never left half written"""
+    monkeypatch.setenv('VIETOCR_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(utils.requests, 'get', lambda url, **kwargs: FakeResponse(PAYLOAD))
+    url = 'https://example.com/model.pth'
+
+    with pytest.raises(ValueError):
+        utils.download_weights(url, md5='0' * 32, quiet=True)
+    assert os.listdir(tmp_path / 'weights') == []
+
+    md5 = hashlib.md5(PAYLOAD).hexdigest()
+    path = utils.download_weights(url, md5=md5, quiet=True)
+    assert open(path, 'rb').read() == PAYLOAD
+
+    # a cached file with the right checksum is reused
+    monkeypatch.setattr(utils.requests, 'get', None)
+    assert utils.download_weights(url, md5=md5, quiet=True) == path
+
+
+@pytest.mark.parametrize('use_safetensors', [False, True])
+def test_load_weights_roundtrip(monkeypatch, tmp_path, use_safetensors):
+    """load_weights returns the saved state dict with either loader"""
+    if use_safetensors and utils.safetensors_torch is None:
+        pytest.skip('safetensors is not installed')
+    if not use_safetensors:
+        monkeypatch.setattr(utils, 'safetensors_torch', None)
+
+    state_dict = {'weight': torch.randn(4, 3), 'bias': torch.randn(4)}
+    path = str(tmp_path / 'model.pth')
+    torch.save(state_dict, path)
+
+    loaded = utils.load_weights(path)
+
+    assert set(loaded) == set(state_dict)
+    assert all(torch.equal(loaded[k], state_dict[k]) for k in state_dict)
+
+
+def test_safetensors_copy_follows_source(monkeypatch, tmp_path):
+    """Converted weights go to the weight store and are rebuilt when the .pth changes"""
+    if utils.safetensors_torch is None:
+        pytest.skip('safetensors is not installed')
+    monkeypatch.setenv('VIETOCR_CACHE_DIR', str(tmp_path / 'cache'))
+    source = tmp_path / 'readonly'
+    source.mkdir()
+    path = str(source / 'model.pth')
+
+    torch.save({'weight': torch.zeros(3)}, path)
+    assert torch.equal(utils.load_weights(path)['weight'], torch.zeros(3))
+    assert os.listdir(source) == ['model.pth']
+    assert os.listdir(tmp_path / 'cache' / 'weights') == [os.path.basename(utils.safetensors_path(path))]
+
+    torch.save({'weight': torch.ones(3)}, path)
+    os.utime(path, ns=(0, 0))
+    assert torch.equal(utils.load_weights(path)['weight'], torch.ones(3))